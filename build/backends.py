@@ -0,0 +1,47 @@
+"""Contains the backends which chains can be clustered with. Each one reads the
+chains to cluster from a FASTA file, and the representatives of existing
+clusters from another when matching new chains to them."""
+
+from chains import get_chain_clusters, get_chain_matches
+from kmer import read_fasta, cluster_sequences, match_sequences
+from utilities import is_cd_hit_installed
+
+class CdHitBackend:
+    """Clusters chains with the CD-HIT binaries, which must be on the PATH."""
+
+    name = "CD-HIT"
+
+    def is_available(self):
+        return is_cd_hit_installed()
+
+
+    def cluster(self, path, sequence_identity):
+        return get_chain_clusters(path, sequence_identity)
+
+
+    def match(self, representatives_path, path, sequence_identity):
+        return get_chain_matches(representatives_path, path, sequence_identity)
+
+
+
+class KmerBackend:
+    """Clusters chains in Python, with the k-mer clusterer."""
+
+    name = "k-mer clusterer"
+
+    def is_available(self):
+        return True
+
+
+    def cluster(self, path, sequence_identity):
+        return cluster_sequences(read_fasta(path), sequence_identity)
+
+
+    def match(self, representatives_path, path, sequence_identity):
+        return match_sequences(
+         read_fasta(representatives_path), read_fasta(path), sequence_identity
+        )
+
+
+
+BACKENDS = {"cd-hit": CdHitBackend, "kmer": KmerBackend}
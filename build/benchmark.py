@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+
+"""This script clusters the chains in the database with each clustering backend
+that is available, and reports how long each took and how well it agrees with
+the chain clusters already in the database. Nothing in the database is
+changed."""
+
+import os
+import time
+import argparse
+from tempfile import TemporaryDirectory
+from collections import Counter
+from utilities import *
+from chains import save_chains_fasta
+from backends import BACKENDS
+setup_django()
+from core.models import Chain
+from cluster import SEQUENCE_IDENTITY
+
+def count_pairs(sizes):
+    """Gets how many pairs can be made within groups of the given sizes."""
+
+    return sum(size * (size - 1) // 2 for size in sizes)
+
+
+def get_pair_agreement(clusters, reference):
+    """Compares two clusterings of the same chains, given as dicts of chain IDs
+    to cluster IDs. The fraction of pairs of chains clustered together in the
+    first which are also together in the reference (precision) is returned,
+    along with the fraction of pairs together in the reference which are also
+    together in the first (recall)."""
+
+    agreed = count_pairs(Counter(
+     (clusters[id], reference[id]) for id in reference
+    ).values())
+    together = count_pairs(Counter(clusters.values()).values())
+    reference_together = count_pairs(Counter(reference.values()).values())
+    return (
+     agreed / together if together else 1,
+     agreed / reference_together if reference_together else 1
+    )
+
+
+def main(backends):
+    reference = dict(Chain.objects.values_list("id", "cluster"))
+    if None in reference.values():
+        print("Not every chain is in a cluster - run cluster.py first")
+        return
+    print(f"Clustering {len(reference)} chains, which are currently in "
+     f"{len(set(reference.values()))} clusters\n")
+    with TemporaryDirectory(prefix="zinc-benchmark-") as directory:
+        fasta = os.path.join(directory, "chains.fasta")
+        save_chains_fasta(Chain.objects.all(), fasta)
+        for name in backends:
+            backend = BACKENDS[name]()
+            if not backend.is_available():
+                print(f"{backend.name}: not installed or not in PATH")
+                continue
+            start = time.time()
+            clusters = backend.cluster(fasta, SEQUENCE_IDENTITY)
+            duration = time.time() - start
+            clustered = {id: cluster[0] for cluster in clusters for id in cluster}
+            clustered = {id: clustered.get(id, id) for id in reference}
+            precision, recall = get_pair_agreement(clustered, reference)
+            print(f"{backend.name}: {len(set(clustered.values()))} clusters in "
+             f"{duration:.2f}s (pair precision {precision:.3f}, "
+             f"pair recall {recall:.3f})")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+     "--backend", action="append", choices=sorted(BACKENDS), dest="backends",
+     help="a backend to benchmark (all of them are by default)"
+    )
+    args = parser.parse_args()
+    print()
+    main(args.backends or sorted(BACKENDS))
+    print()
@@ -3,57 +3,74 @@
 """This script will update the database with new PDBs, but won't cluster."""
 
 from utilities import *
+from stats import save_stats
 setup_django()
 from tqdm import tqdm
+import time
+import argparse
 import traceback
+import functools
+import multiprocessing
 from django.db import transaction
-from core.models import Pdb
+from django.db.models import F
+from core.models import Pdb, ManifestEntry, JournalEntry, DatabaseVersion
+from core.search import update_search_indexes
 from django.conf import settings
 if not settings.DEBUG: tqdm = lambda l: l
 
-def process_pdb_code(code):
+# PDBs which have failed fewer times than this are tried again by every build,
+# in case they failed for a reason which has since gone away
+RETRY_FAILED = 3
+
+def process_pdb_code(code, offline=False):
     """Builds all the relevant objects for any given PDB code."""
 
-    from factories import create_pdb_record, create_metal_record
-    from factories import create_chain_record, create_site_record
+    save_pdb_analysis(analyse_pdb_code(code, offline=offline))
+
+
+def analyse_pdb_code(code, offline=False):
+    """Fetches a PDB and works out everything about it that needs to be saved,
+    without touching the database. The result is a dict of plain data, with no
+    atomium objects in it, which can be passed to save_pdb_analysis. In offline
+    mode the PDB must already be in the local structure cache."""
 
     # Get PDB
     log(f"Fetching {code}")
-    pdb = atomium.fetch(code)
+    pdb, revision = fetch_structure(code, offline=offline)
     log(f"Getting best {code} assembly")
     model, assembly_id = get_best_model(pdb)
-    model.optimise_distances()
-    log(f"Saving {code} to database")
-    pdb_record = create_pdb_record(pdb, assembly_id)
+    context = StructureContext(pdb, model)
+    analysis = {
+     "code": code, "revision": revision, "pdb": describe_pdb(pdb),
+     "assembly_id": assembly_id, "pdb_skeleton": context.pdb_skeleton,
+     "skeleton": False, "skeleton_zincs": [], "outside_zincs": [],
+     "useless_metals": [], "chains": [], "sites": []
+    }
 
     # Check model is usable
-    if model_is_skeleton(model):
-        for zinc in sorted(model.atoms(element="ZN"), key=lambda m: m.id):
-            create_metal_record(zinc, pdb_record,
-             omission="No side chain information in PDB."
-            )
-        return
+    if context.skeleton:
+        analysis["skeleton"] = True
+        analysis["skeleton_zincs"] = [describe_metal(m)
+         for m in sorted(context.zincs, key=lambda m: m.id)]
+        return analysis
 
-    # Save any zincs not in model
-    for zinc in sorted(zincs_outside_model(model, pdb), key=lambda m: m.id):
-        create_metal_record(zinc, pdb_record,
-         omission="Zinc in asymmetric unit but not biological assembly."
-        )
+    # Get any zincs not in model
+    analysis["outside_zincs"] = [describe_metal(m) for m in sorted(
+     zincs_outside_model(context), key=lambda m: m.id
+    )]
 
     # Get metals
     log(f"Finding {code} liganding atoms")
-    metals = remove_duplicate_atoms(model.atoms(is_metal=True))
+    metals = remove_duplicate_atoms(context.metals)
 
     # Determine liganding atoms of all metals
-    metals = {m: get_atom_liganding_atoms(m) for m in metals}
+    metals = get_liganding_atoms(metals, context.index)
 
     # Ignore metals with too few liganding atoms
     useless_metals = remove_salt_metals(metals)
-    for metal in sorted(useless_metals, key=lambda m: m.id):
-        if metal.element == "ZN":
-            create_metal_record(metal, pdb_record,
-             omission="Zinc has too few liganding atoms."
-            )
+    analysis["useless_metals"] = [describe_metal(m) for m in sorted(
+     [m for m in useless_metals if m.element == "ZN"], key=lambda m: m.id
+    )]
 
     log(f"Processing {code} sites")
     # Get list of binding site dicts from the metals dict
@@ -70,47 +87,254 @@ def process_pdb_code(code):
     # Sort sites to make ID allocation deterministic
     sites.sort(key=lambda s: min(a.id for a in s["metals"].keys()))
 
-    # Add residues and chains to site dicts
+    # Add residues, chains and their sequences, and stabilisers to site dicts
     for site in sites:
         site["residues"] = get_site_residues(site)
         site["chains"] = get_site_chains(site)
-    
-    # Create chains involved in all binding sites
+        site["sequences"] = {
+         chain.id: get_chain_sequence(chain, site["residues"])
+         for chain in site["chains"]
+        }
+        site["second_residues"], site["stabiliser_contacts"] = \
+         get_site_stabilisers(site, context.index)
+    keys = {}
+    analysis["sites"] = [describe_site(site, keys) for site in sites]
+
+    # Get chains involved in all binding sites
     log(f"Processing {code} chains")
     chains, residues = get_all_chains(sites), get_all_residues(sites)
+    analysis["chains"] = [
+     (chain.id, get_chain_sequence(chain, residues)) for chain in chains
+    ]
+    return analysis
+
+
+def analyse_pdb_code_safely(code, offline=False):
+    """Analyses a PDB code in a worker process. The analysis is returned along
+    with any failure (the exception's name and traceback) rather than the
+    exception being raised, so that the writer process can record it. The time
+    taken is also returned."""
+
+    start = time.time()
+    try:
+        analysis = analyse_pdb_code(code, offline=offline)
+    except Exception as e:
+        return None, (type(e).__name__, traceback.format_exc()), time.time() - start
+    return analysis, None, time.time() - start
+
+
+def save_pdb_analysis(analysis):
+    """Creates all the relevant database records from a PDB analysis dict. Any
+    existing records for the PDB, from an older revision, are replaced."""
+
+    from factories import RecordWriter, create_pdb_record, create_metal_record
+    from factories import create_chain_record, create_site_record
+
+    code = analysis["code"]
+    log(f"Saving {code} to database")
+    Pdb.objects.filter(id=code).delete()
+    ManifestEntry.objects.filter(id=code).delete()
+    writer = RecordWriter()
+    writer.add(ManifestEntry(id=code, revision=analysis["revision"]))
+    pdb_record = create_pdb_record(
+     writer, analysis["pdb"], analysis["assembly_id"], analysis["pdb_skeleton"]
+    )
+
+    # Skeleton models have their zincs saved, but nothing else
+    if analysis["skeleton"]:
+        for zinc in analysis["skeleton_zincs"]:
+            create_metal_record(writer, zinc, pdb_record,
+             omission="No side chain information in PDB."
+            )
+        writer.save()
+        return
+
+    # Save any zincs not in model
+    for zinc in analysis["outside_zincs"]:
+        create_metal_record(writer, zinc, pdb_record,
+         omission="Zinc in asymmetric unit but not biological assembly."
+        )
+
+    # Save zincs with too few liganding atoms
+    for metal in analysis["useless_metals"]:
+        create_metal_record(writer, metal, pdb_record,
+         omission="Zinc has too few liganding atoms."
+        )
+
+    # Create chains involved in all binding sites
     chains_dict = {}
-    for chain in chains:
-        sequence = get_chain_sequence(chain, residues)
-        chains_dict[chain.id] = create_chain_record(chain, pdb_record, sequence)
-    
-    # Save sites to database
-    for index, site in enumerate(sites, start=1):
-        log(f"Saving {code} site")
-        site_record = create_site_record(site, pdb_record, index, chains_dict)
+    for chain_id, sequence in analysis["chains"]:
+        chains_dict[chain_id] = create_chain_record(
+         writer, chain_id, pdb_record, sequence
+        )
+
+    # Create sites
+    for index, site in enumerate(analysis["sites"], start=1):
+        site_record = create_site_record(
+         writer, site, pdb_record, index, chains_dict
+        )
+
+    # Save everything to database
+    writer.save()
 
 
-def main():
+def get_codes_to_update(codes, offline=False):
+    """Compares the manifest of processed PDBs with the current PDB codes and
+    their revisions. PDBs that are no longer current are deleted, and the codes
+    of those which are new, or have been revised since they were processed, are
+    returned. PDBs processed before the manifest existed count as revised."""
+
+    if offline:
+        revisions = {code: get_cached_revisions(code)[-1] for code in codes}
+    else:
+        revisions = get_pdb_revisions(codes)
+    manifest = dict(ManifestEntry.objects.values_list("id", "revision"))
+    obsolete = sorted(set(Pdb.objects.values_list("id", flat=True)) - set(codes))
+    for start in range(0, len(obsolete), 500):
+        Pdb.objects.filter(id__in=obsolete[start:start + 500]).delete()
+        ManifestEntry.objects.filter(id__in=obsolete[start:start + 500]).delete()
+    print(f"Deleted {len(obsolete)} obsolete PDBs")
+    return [code for code in codes if code not in manifest or (
+     code in revisions and revisions[code] != manifest[code]
+    )]
+
+
+def mark_codes_pending(codes):
+    """Records in the build journal that some PDB codes are about to be
+    processed, so that an interrupted build can be resumed."""
+
+    with transaction.atomic():
+        for start in range(0, len(codes), 500):
+            batch = codes[start:start + 500]
+            JournalEntry.objects.filter(id__in=batch).update(state="pending")
+            existing = set(JournalEntry.objects.filter(
+             id__in=batch
+            ).values_list("id", flat=True))
+            JournalEntry.objects.bulk_create([JournalEntry(
+             id=code, state="pending"
+            ) for code in batch if code not in existing])
+
+
+def record_outcome(code, duration, failure=None):
+    """Records in the build journal the result of processing a PDB code. A
+    failure, if given, is the exception's name and its traceback."""
+
+    exception, tb = failure or ("", "")
+    JournalEntry.objects.filter(id=code).update(
+     state="failed" if failure else "done", attempts=F("attempts") + 1,
+     duration=duration, exception=exception, traceback=tb
+    )
+
+
+def main(workers=1, offline=False, incremental=False, resume=False, retry_failed=RETRY_FAILED):
     log("\n\n\nSTARTING DATABASE BUILD")
-    # What PDBs have zinc in them?
-    codes = get_zinc_pdb_codes()
-    print(f"There are {len(codes)} PDB codes with zinc")
+    if resume:
+        # Which PDBs did the last build not get to?
+        codes_to_check = list(JournalEntry.objects.exclude(
+         state="done"
+        ).order_by("id").values_list("id", flat=True))
+        print(f"Resuming with {len(codes_to_check)} unfinished PDB codes")
+    else:
+        # What PDBs have zinc in them?
+        codes = get_cached_codes() if offline else get_zinc_pdb_codes()
+        print(f"There are {len(codes)} PDB codes with zinc")
+
+        # How many should be checked
+        if incremental:
+            codes_to_check = get_codes_to_update(codes, offline=offline)
+        else:
+            current_codes = Pdb.objects.all().values_list("id", flat=True)
+            codes_to_check = [code for code in codes if code not in current_codes]
 
-    # How many should be checked
-    current_codes = Pdb.objects.all().values_list("id", flat=True)
-    codes_to_check = [code for code in codes if code not in current_codes]
+    # Skip PDBs known to fail, unless they are to be retried
+    failed = dict(JournalEntry.objects.filter(
+     state="failed"
+    ).values_list("id", "attempts"))
+    skipped = [code for code in codes_to_check
+     if code in failed and failed[code] >= retry_failed]
+    if skipped:
+        print(f"Skipping {len(skipped)} PDBs that failed previously")
+        codes_to_check = [code for code in codes_to_check if code not in skipped]
     print(f"{len(codes_to_check)} of these need to be checked")
+    mark_codes_pending(codes_to_check)
 
-    # Check
+    # Analyse in worker processes if requested, but only ever write from here
+    analyse = functools.partial(analyse_pdb_code_safely, offline=offline)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    if pool:
+        results = pool.imap(analyse, codes_to_check)
+    else:
+        results = map(analyse, codes_to_check)
+
+    # Check - a result which can't be sent back from its worker fails when it
+    # is received, and is recorded as that code's failure
     unprocessable = {}
-    for code in tqdm(codes_to_check):
-        try:
-            with transaction.atomic(): process_pdb_code(code)
-        except Exception as e: unprocessable[code] = traceback.format_exc()
+    try:
+        for code in tqdm(codes_to_check):
+            try:
+                analysis, failure, duration = next(results)
+            except Exception as e:
+                analysis, duration = None, 0
+                failure = (type(e).__name__, traceback.format_exc())
+            if not failure:
+                start = time.time()
+                try:
+                    with transaction.atomic():
+                        save_pdb_analysis(analysis)
+                        record_outcome(code, duration + time.time() - start)
+                    continue
+                except Exception as e:
+                    failure = (type(e).__name__, traceback.format_exc())
+                    duration += time.time() - start
+            unprocessable[code] = failure
+            record_outcome(code, duration, failure)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    # Work out the homepage statistics and search indexes again, and give the
+    # database a new version so that responses from before are no longer used
+    save_stats()
+    update_search_indexes()
+    DatabaseVersion.bump()
+
+    # Report failures, grouped by what went wrong
     print("The following PDBs could not be processed:\n")
     start, end = "\033[91m", "\033[0m"
-    for code in unprocessable: print(f"{code}\n{start}{unprocessable[code]}{end}")
+    exceptions = sorted(set(e for e, tb in unprocessable.values()))
+    for exception in exceptions:
+        codes = [c for c, f in unprocessable.items() if f[0] == exception]
+        print(f"{exception} ({len(codes)} PDBs)")
+        for code in codes:
+            print(f"{code}\n{start}{unprocessable[code][1]}{end}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+     "--workers", type=int, default=1,
+     help="number of processes to analyse PDBs with"
+    )
+    parser.add_argument(
+     "--offline", action="store_true",
+     help="build only from PDBs in the local structure cache"
+    )
+    parser.add_argument(
+     "--incremental", action="store_true",
+     help="also reprocess revised PDBs and delete obsolete ones"
+    )
+    parser.add_argument(
+     "--resume", action="store_true",
+     help="only process PDBs which the last build didn't finish"
+    )
+    parser.add_argument(
+     "--retry-failed", type=int, default=RETRY_FAILED, metavar="N",
+     help="retry PDBs that have previously failed fewer than N times"
+    )
+    args = parser.parse_args()
     print()
-    main()
+    main(
+     workers=args.workers, offline=args.offline, incremental=args.incremental,
+     resume=args.resume, retry_failed=args.retry_failed
+    )
     print()
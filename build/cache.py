@@ -0,0 +1,115 @@
+"""Contains functions for fetching structures and keeping a local copy of them,
+so that the build doesn't have to download the same files again."""
+
+import os
+import re
+import gzip
+import requests
+from atomium.utilities import parse_string
+from django.conf import settings
+
+def get_pdb_revision(code):
+    """Gets the current revision of a PDB entry from the RCSB, as a string of
+    the form major.minor."""
+
+    url = f"https://data.rcsb.org/rest/v1/core/entry/{code}"
+    response = requests.get(url)
+    if response.status_code == 200:
+        info = response.json()["rcsb_accession_info"]
+        return f"{info['major_revision']}.{info['minor_revision']}"
+    raise Exception(f"RCSB didn't send back a revision for {code}")
+
+
+def get_pdb_revisions(codes):
+    """Gets the current revisions of many PDB entries from the RCSB, as a dict
+    of codes to revision strings. Entries are requested in batches, so this
+    takes a handful of requests rather than one per code. Codes the RCSB no
+    longer knows about will not be in the dict."""
+
+    query = "query($ids: [String!]!) { entries(entry_ids: $ids) { rcsb_id "\
+     "rcsb_accession_info { major_revision minor_revision } } }"
+    revisions = {}
+    for start in range(0, len(codes), 1000):
+        response = requests.post("https://data.rcsb.org/graphql", json={
+         "query": query, "variables": {"ids": codes[start:start + 1000]}
+        })
+        if response.status_code != 200:
+            raise Exception("RCSB didn't send back PDB revisions")
+        for entry in response.json()["data"]["entries"]:
+            if entry:
+                info = entry["rcsb_accession_info"]
+                revisions[entry["rcsb_id"]] = \
+                 f"{info['major_revision']}.{info['minor_revision']}"
+    return revisions
+
+
+def get_cache_path(code, revision):
+    """Gets the location in the structure cache where a given revision of a
+    PDB entry is stored."""
+
+    return os.path.join(
+     settings.STRUCTURE_CACHE, f"{code.lower()}_{revision}.cif.gz"
+    )
+
+
+def get_cached_revisions(code):
+    """Gets the revisions of a PDB entry that are in the structure cache, oldest
+    first."""
+
+    if not os.path.isdir(settings.STRUCTURE_CACHE): return []
+    pattern = re.compile(rf"{code.lower()}_(\d+\.\d+)\.cif\.gz$")
+    revisions = [match.group(1) for match in map(
+     pattern.match, os.listdir(settings.STRUCTURE_CACHE)
+    ) if match]
+    return sorted(revisions, key=lambda r: [int(n) for n in r.split(".")])
+
+
+def get_cached_codes():
+    """Gets the PDB codes of every entry in the structure cache."""
+
+    if not os.path.isdir(settings.STRUCTURE_CACHE): return []
+    pattern = re.compile(r"(.+?)_\d+\.\d+\.cif\.gz$")
+    return sorted(set(match.group(1).upper() for match in map(
+     pattern.match, os.listdir(settings.STRUCTURE_CACHE)
+    ) if match))
+
+
+def save_to_cache(code, revision):
+    """Downloads the compressed mmCIF file for a revision of a PDB entry and
+    saves it to the structure cache. The file is written under a temporary name
+    first so that concurrent builds never see a partial file."""
+
+    url = f"https://files.rcsb.org/download/{code.lower()}.cif.gz"
+    response = requests.get(url)
+    if response.status_code != 200:
+        raise ValueError(f"Could not find anything at {url}")
+    os.makedirs(settings.STRUCTURE_CACHE, exist_ok=True)
+    path = get_cache_path(code, revision)
+    with open(path + f".{os.getpid()}", "wb") as f: f.write(response.content)
+    os.replace(path + f".{os.getpid()}", path)
+    return path
+
+
+def open_cached_structure(path):
+    """Parses a compressed mmCIF file from the structure cache."""
+
+    with gzip.open(path, "rt") as f: filestring = f.read()
+    return parse_string(filestring, path[:-3])
+
+
+def fetch_structure(code, offline=False):
+    """Fetches a PDB entry through the structure cache, and returns the parsed
+    file along with its revision. The current revision is looked up and only
+    downloaded if it isn't already cached. In offline mode, the latest cached
+    revision is used and nothing is fetched over the network."""
+
+    if offline:
+        revisions = get_cached_revisions(code)
+        if not revisions:
+            raise ValueError(f"{code} is not in the structure cache")
+        revision = revisions[-1]
+    else:
+        revision = get_pdb_revision(code)
+    path = get_cache_path(code, revision)
+    if not os.path.exists(path): save_to_cache(code, revision)
+    return open_cached_structure(path), revision
@@ -1,17 +1,19 @@
 """Contains functions for dealing with chains and chain sequences."""
 
+import os
 import subprocess
 import re
+import numpy as np
+from functools import lru_cache
 
 def get_all_chains(sites):
     """Takes a list of site dicts, and gets all chains with unique IDs."""
 
-    chains = set()
+    chains = {}
     for site in sites:
         for chain in site["chains"]:
-            if chain.id not in [c.id for c in chains]:
-                chains.add(chain)
-    return chains
+            chains.setdefault(chain.id, chain)
+    return set(chains.values())
 
 
 def get_all_residues(sites):
@@ -29,12 +31,13 @@ def get_chain_sequence(chain, residues):
 
     full = "".join(res.code for res in chain)
     alignment = align_sequences(full, chain.sequence)
-    seq, indices, dash_count = "", [], 0
+    residue_ids = set(r.id for r in residues)
+    seq, indices, dash_count = "", set(), 0
     for i, char in enumerate(alignment[0]):
         if char == "-":
             dash_count += 1
-        elif chain[i - dash_count].id in [r.id for r in residues]:
-            indices.append(i)
+        elif chain[i - dash_count].id in residue_ids:
+            indices.add(i)
     for i, char in enumerate(chain.sequence):
         seq += char.upper() if i in indices else char.lower()
     return seq
@@ -51,24 +54,35 @@ def match_score(alpha, beta, match_award, mismatch_penalty, gap_penalty):
         return mismatch_penalty
 
 
+@lru_cache(maxsize=1024)
 def align_sequences(seq1, seq2):
-    """Adapted from github.com/alevchuk/pairwise-alignment-in-python/"""
+    """Adapted from github.com/alevchuk/pairwise-alignment-in-python/
+
+    Each row of the score matrix is filled in at once using NumPy. Gaps within
+    a row depend on the cell to their left, so they are resolved with a running
+    maximum. Alignments are cached, as the same chain is aligned once for
+    itself and again for every site it is part of."""
 
     match_award      = 10
     mismatch_penalty = -5
     gap_penalty      = -5
     m, n = len(seq1), len(seq2)
-    score = [[0 for y in range(n + 1)] for x in range(m + 1)]
-    for i in range(0, m + 1): score[i][0] = gap_penalty * i
-    for j in range(0, n + 1): score[0][j] = gap_penalty * j
+    score = np.zeros((m + 1, n + 1), dtype=np.int32)
+    gaps = gap_penalty * np.arange(n + 1, dtype=np.int32)
+    score[0] = gaps
+    score[:, 0] = gap_penalty * np.arange(m + 1)
+    residues2 = np.array(list(seq2), dtype=str)
+    gapped2 = residues2 == "-"
+    best = np.empty(n + 1, dtype=np.int32)
     for i in range(1, m + 1):
-        for j in range(1, n + 1):
-            match = score[i - 1][j - 1] + match_score(
-             seq1[i-1], seq2[j-1], match_award, mismatch_penalty, gap_penalty
-            )
-            delete = score[i - 1][j] + gap_penalty
-            insert = score[i][j - 1] + gap_penalty
-            score[i][j] = max(match, delete, insert)
+        matches = np.where(residues2 == seq1[i - 1], match_award, np.where(
+         gapped2 | (seq1[i - 1] == "-"), gap_penalty, mismatch_penalty
+        ))
+        best[0] = score[i][0]
+        best[1:] = np.maximum(
+         score[i - 1, :-1] + matches, score[i - 1, 1:] + gap_penalty
+        )
+        score[i] = np.maximum.accumulate(best - gaps) + gaps
     align1, align2 = "", ""
     i, j = m, n
     while i > 0 and j > 0:
@@ -106,26 +120,138 @@ def get_all_chains_fasta():
     """Gets the text of a FASTA file representing all chains in the database."""
 
     from core.models import Chain
-    lines = []
-    for chain in Chain.objects.all():
-        lines.append(">lcl|" + str(chain.id))
+    return "\n".join(get_fasta_lines(Chain.objects.all()))
+
+
+def get_fasta_lines(chains):
+    """Yields the lines of a FASTA file representing some Chain records."""
+
+    for chain in chains:
+        yield ">lcl|" + str(chain.id)
         sequence = chain.sequence
         while sequence:
-            lines.append(sequence[:80])
+            yield sequence[:80]
             sequence = sequence[80:]
-    return "\n".join(lines)
 
 
-def get_chain_clusters(sequence_identity):
-    """Uses the CD-Hit binary to cluster chains into chain clusters, and returns
-    these clusters as lists of chain IDs."""
-    
-    subprocess.call(
-     "cd-hit -i chains.fasta -d 0 -o temp -c {} -n 5 -G 1 -g 1 -b 20 -s 0.0 -aL "
-     "0.0 -aS 0.0 -T 4 -M 32000".format(sequence_identity),
-     shell=True, stdout=subprocess.PIPE
+def save_chains_fasta(chains, path, ids=None):
+    """Writes a FASTA file representing some Chain records, one line at a time,
+    so that the whole file is never held in memory. If a queryset is given, its
+    chains are streamed from the database, and if a set of IDs is given, only
+    the chains with those IDs are written."""
+
+    if hasattr(chains, "iterator"):
+        chains = chains.only("id", "sequence").iterator()
+    if ids is not None:
+        chains = (chain for chain in chains if chain.id in ids)
+    with open(path, "w") as f:
+        for line in get_fasta_lines(chains):
+            f.write(line + "\n")
+
+
+def get_cd_hit_resources():
+    """Works out how many threads and how much memory (in MB) CD-Hit should use
+    on this machine - every CPU available to this process, and most of the
+    memory not currently in use. A memory of 0 tells CD-Hit to not limit
+    itself, and is used if available memory can't be found out."""
+
+    try:
+        threads = len(os.sched_getaffinity(0))
+    except AttributeError:
+        threads = os.cpu_count() or 1
+    try:
+        with open("/proc/meminfo") as f:
+            info = dict(line.split(":", 1) for line in f)
+        memory = int(int(info["MemAvailable"].split()[0]) / 1024 * 0.8)
+    except (OSError, KeyError, ValueError):
+        memory = 0
+    return threads, memory
+
+
+def get_word_length(sequence_identity):
+    """Gets the longest word length which CD-Hit allows for a given sequence
+    identity threshold."""
+
+    if sequence_identity >= 0.7: return 5
+    if sequence_identity >= 0.6: return 4
+    if sequence_identity >= 0.5: return 3
+    return 2
+
+
+def run_cd_hit(program, sequence_identity, *args):
+    """Runs a CD-Hit program at some sequence identity with the options shared
+    by every run, and with threads and memory suited to this machine."""
+
+    threads, memory = get_cd_hit_resources()
+    subprocess.run([
+     program, *args, "-c", str(sequence_identity),
+     "-n", str(get_word_length(sequence_identity)), "-d", "0", "-G", "1",
+     "-g", "1", "-b", "20", "-aL", "0.0", "-aS", "0.0", "-T", str(threads),
+     "-M", str(memory)
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def get_chain_clusters(path, sequence_identity):
+    """Uses the CD-Hit binary to cluster the chains in a FASTA file into chain
+    clusters, and returns these clusters as lists of chain IDs. CD-Hit's own
+    files are written alongside the FASTA file."""
+
+    output = os.path.join(os.path.dirname(path), "temp")
+    run_cd_hit(
+     "cd-hit", sequence_identity, "-i", path, "-o", output, "-s", "0.0"
     )
-    with open("temp.clstr") as f: data = f.read()
-    clusters = data.split(">Cluster ")[1:]
-    clusters = [re.compile(r">(.+?)\.\.\.").findall(c) for c in clusters]
-    return [[chain.split("|")[1] for chain in cluster] for cluster in clusters]
+    return list(parse_cluster_file(output + ".clstr"))
+
+
+def get_age_key(record):
+    """Gets a key which sorts Chain or ZincSite records, annotated with their
+    PDB's deposition date, oldest first. Records with no date come last, and
+    ties go to the lowest ID, so every cluster and group has one oldest
+    record."""
+
+    return (record.date is None, record.date, record.id)
+
+
+def get_cluster_representatives(chains):
+    """Gets the chain which represents each chain cluster, from a dict of
+    chain IDs to Chain records with their dates, as a dict of cluster IDs to
+    Chain records. This is the chain the cluster is named after if it still
+    exists, or else the oldest chain left in the cluster."""
+
+    representatives = {}
+    for chain in sorted(chains.values(), key=get_age_key):
+        if chain.cluster_id is None: continue
+        if chain.cluster_id not in representatives \
+         or chain.id == chain.cluster_id:
+            representatives[chain.cluster_id] = chain
+    return representatives
+
+
+def get_chain_matches(representatives_path, path, sequence_identity):
+    """Uses the CD-Hit binary to compare the chains in one FASTA file with the
+    representatives of existing chain clusters in another, and returns each
+    representative which chains matched, along with those chains, as lists of
+    chain IDs."""
+
+    output = os.path.join(os.path.dirname(path), "temp")
+    run_cd_hit(
+     "cd-hit-2d", sequence_identity, "-i", representatives_path, "-i2", path,
+     "-o", output, "-s", "0.0", "-s2", "0.0", "-S2", "999999"
+    )
+    return [c for c in parse_cluster_file(output + ".clstr") if len(c) > 1]
+
+
+def parse_cluster_file(path):
+    """Reads a CD-Hit cluster file one line at a time, and yields its clusters
+    as lists of chain IDs."""
+
+    pattern = re.compile(r">(.+?)\.\.\.")
+    cluster = None
+    with open(path) as f:
+        for line in f:
+            if line.startswith(">Cluster "):
+                if cluster is not None: yield cluster
+                cluster = []
+            elif cluster is not None:
+                cluster += [id.split("|")[1] for id in pattern.findall(line)]
+    if cluster is not None: yield cluster
@@ -1,80 +1,274 @@
 #! /usr/bin/env python3
 
-"""This script will cluster chains and sites, after removing existing ones."""
+"""This script will cluster chains and sites, replacing existing clusters and
+groups. In incremental mode, existing clusters and groups are kept, and only
+chains and sites which aren't in one yet are clustered. Either way, the clusters
+and groups are then clustered again at each lower sequence identity. Nothing in
+the database changes until everything has been clustered, and then it all
+changes at once."""
 
 import sys
 import os
+import argparse
+from tempfile import TemporaryDirectory
 from utilities import *
-from chains import get_all_chains_fasta, get_chain_clusters
-from sites import get_site_clusters, add_fingerprint_to_site
+from chains import save_chains_fasta
+from chains import get_cluster_representatives
+from backends import BACKENDS
+from sites import get_site_clusters, add_fingerprints_to_sites
+from sites import get_coarser_fingerprint, PdbIndex
+from stats import save_stats
 setup_django()
 from tqdm import tqdm
-from django.db import transaction
-from django.db.models import F
-from core.models import ChainCluster, Group, ZincSite, Chain
+from django.db.models import F, Q
+from core.models import ChainCluster, Group, ZincSite, Chain, DatabaseVersion
+from core.search import update_search_indexes
 from django.conf import settings
 if not settings.DEBUG: tqdm = lambda l: l
 
-SEQUENCE_IDENTITY = 0.9
+SEQUENCE_IDENTITIES = settings.SEQUENCE_IDENTITIES
+SEQUENCE_IDENTITY = SEQUENCE_IDENTITIES[0]
 
-def main():
-    from factories import create_chain_cluster_record, create_group_record
+def main(incremental=False, backend="cd-hit"):
+    from factories import save_clustering
 
-    # Check if CD-HIT is installed
-    if not is_cd_hit_installed():
-        print("Cannot proceed as CD-HIT is not installed or not in PATH")
+    # Check if the clustering backend can be used
+    backend = BACKENDS[backend]()
+    if not backend.is_available():
+        print(f"Cannot proceed as {backend.name} is not installed or not in PATH")
         sys.exit()
 
-    try:
-        # Remove any existing clusters and groups
-        clusters, groups = ChainCluster.objects.all(), Group.objects.all()
-        text = f"Deleted {clusters.count()} chain clusters and {groups.count()} site groups"
-        clusters.delete()
-        groups.delete()
-        print(text)
-
-        # Save temporary FASTA file
-        fasta = get_all_chains_fasta()
-        with open("chains.fasta", "w") as f: f.write(fasta)
-        print("Saved current chains to chains.fasta ({:.2f} KB)".format(len(fasta) / 1024))
-
-        # Run CD-HIT
-        clusters = get_chain_clusters(SEQUENCE_IDENTITY)
-        print(f"Clustered chains into {len(clusters)} clusters ({SEQUENCE_IDENTITY * 100}% sequence identity)")
-
-        # Save clusters to database
-        print("Saving these to the database...")
-        chain_dates = {chain.id: chain.date for chain in
-         Chain.objects.all().annotate(date=F("pdb__deposition_date"))}
-        with transaction.atomic():
-            for cluster in tqdm(clusters):
-                create_chain_cluster_record(cluster, chain_dates)
-        for chain in Chain.objects.filter(cluster=None):
-            create_chain_cluster_record([chain.id], chain_dates)
-        
-        # Cluster sites based on chain clusters
-        print("Clustering zinc sites based on associated chains...")
-        sites = ZincSite.objects.all().annotate(date=F("pdb__deposition_date"))
-        for site in tqdm(sites):
-            add_fingerprint_to_site(site)
-        site_clusters = get_site_clusters(sites)
-
-        # Save zinc site clusters to database
-        print("Saving these clusters to the database...")
-        with transaction.atomic():
-            for sites in tqdm(site_clusters.values()):
-                create_group_record(sites)
-
-    finally:
-        # Remove any temporary files saved
-        for filename in ["chains.fasta", "temp", "temp.clstr"]:
-            try:
-                os.remove(filename)
-            except: pass
+    # PDB titles are indexed once, for describing every group made
+    index = PdbIndex()
 
+    # Everything is clustered in memory, with the chains and sites loaded once -
+    # sequences are left in the database, and streamed from it when needed
+    chains = Chain.objects.only("id", "cluster").annotate(
+     date=F("pdb__deposition_date")
+    ).order_by("id").in_bulk()
+    sites = ZincSite.objects.only(
+     "id", "family", "representative", "fingerprint", "pdb", "group"
+    ).annotate(date=F("pdb__deposition_date")).order_by("id").in_bulk()
+
+    # Temporary files go in a directory of their own, which is then removed
+    with TemporaryDirectory(prefix="zinc-clustering-") as directory:
+        if incremental and ChainCluster.objects.exists():
+            clusters, groups = cluster_incrementally(
+             backend, directory, index, chains, sites
+            )
+        else:
+            clusters, groups = cluster_everything(
+             backend, directory, index, chains, sites
+            )
+        cluster_coarser_levels(
+         backend, directory, index, chains, sites, clusters, groups
+        )
+
+    # Replace the clusters and groups in the database in one go
+    print("Saving clusters and groups to the database...")
+    save_clustering({
+     ChainCluster: clusters.values(), Chain: chains.values(),
+     Group: groups.values(), ZincSite: sites.values()
+    })
+    print(f"Saved {len(clusters)} chain clusters and {len(groups)} site groups")
+
+    # Representatives and groups have changed, so the statistics and group
+    # search index have too, and the database needs a new version
+    save_stats()
+    update_search_indexes([Group])
+    DatabaseVersion.bump()
+
+
+def cluster_everything(backend, directory, index, chains, sites):
+    """Clusters every chain and site from scratch, using the clustering backend
+    given, ignoring any existing clusters and groups. The chains and sites are
+    given as dicts of IDs to records, which are updated, and the new clusters
+    and groups are returned as dicts of IDs to records. Temporary files are
+    saved in the directory given, and groups are described using the PdbIndex
+    given."""
+
+    from factories import create_chain_cluster_records, create_group_records
+
+    # Save temporary FASTA file
+    fasta = os.path.join(directory, "chains.fasta")
+    save_chains_fasta(Chain.objects.order_by("id"), fasta)
+    print("Saved current chains to chains.fasta ({:.2f} KB)".format(os.path.getsize(fasta) / 1024))
+
+    # Run the clustering backend
+    clustered = backend.cluster(fasta, SEQUENCE_IDENTITY)
+    print(f"Clustered chains into {len(clustered)} clusters ({SEQUENCE_IDENTITY * 100}% sequence identity)")
+
+    # Chains left out by the backend get clusters of their own
+    for chain in chains.values(): chain.cluster_id = None
+    clusters = create_chain_cluster_records(clustered, chains)
+    clusters += create_chain_cluster_records([[id] for id, chain in
+     chains.items() if chain.cluster_id is None], chains)
+
+    # Cluster sites based on chain clusters
+    print("Clustering zinc sites based on associated chains...")
+    add_fingerprints_to_sites(ZincSite.objects.all(), sites, chains)
+    groups = create_group_records(
+     get_site_clusters(sites.values()).values(), index
+    )
+    return {c.id: c for c in clusters}, {g.id: g for g in groups}
+
+
+def cluster_incrementally(backend, directory, index, chains, sites):
+    """Adds chains which aren't in a cluster to the existing cluster whose
+    representative they match, and clusters any left over into new clusters.
+    Sites which aren't in a group are then added to the existing group with
+    their fingerprint, or put into new groups, so that existing IDs are kept.
+    The chains and sites are given as dicts of IDs to records, which are
+    updated, and the clusters and groups are returned as dicts of IDs to
+    records. Temporary files are saved in the directory given, and groups are
+    described using the PdbIndex given."""
+
+    from factories import create_chain_cluster_records, create_group_records
+    from factories import update_group_record
+
+    # Remove clusters and groups which no longer have anything in them
+    clusters = ChainCluster.objects.filter(identity=SEQUENCE_IDENTITY).in_bulk()
+    groups = Group.objects.filter(identity=SEQUENCE_IDENTITY).in_bulk()
+    cluster_count, group_count = len(clusters), len(groups)
+    used = set(chain.cluster_id for chain in chains.values())
+    clusters = {id: c for id, c in clusters.items() if id in used}
+    used = set(site.group_id for site in sites.values())
+    groups = {id: g for id, g in groups.items() if id in used}
+    print(f"Removed {cluster_count - len(clusters)} empty chain clusters and {group_count - len(groups)} empty site groups")
+
+    # Compare new chains with the representatives of existing clusters
+    fasta = os.path.join(directory, "chains.fasta")
+    reps_fasta = os.path.join(directory, "reps.fasta")
+    new_chains = [c for c in chains.values() if c.cluster_id is None]
+    representatives = get_cluster_representatives(chains)
+    print(f"Comparing {len(new_chains)} new chains with {len(representatives)} existing clusters")
+    if new_chains and representatives:
+        save_chains_fasta(Chain.objects.order_by("id"), reps_fasta, set(
+         c.id for c in representatives.values()
+        ))
+        save_chains_fasta(
+         Chain.objects.order_by("id"), fasta, set(c.id for c in new_chains)
+        )
+        rep_clusters = {c.id: id for id, c in representatives.items()}
+        matched = 0
+        for cluster in tqdm(backend.match(reps_fasta, fasta, SEQUENCE_IDENTITY)):
+            reps = [id for id in cluster if id in rep_clusters]
+            chain_ids = [id for id in cluster if id not in rep_clusters]
+            for id in chain_ids: chains[id].cluster_id = rep_clusters[reps[0]]
+            matched += len(chain_ids)
+        print(f"Added {matched} new chains to existing clusters")
+
+    # Cluster the remaining new chains among themselves
+    new_chains = [c for c in chains.values() if c.cluster_id is None]
+    if new_chains:
+        save_chains_fasta(
+         Chain.objects.order_by("id"), fasta, set(c.id for c in new_chains)
+        )
+        clustered = backend.cluster(fasta, SEQUENCE_IDENTITY)
+        print(f"Clustered remaining chains into {len(clustered)} new clusters")
+        new_clusters = create_chain_cluster_records(clustered, chains)
+        new_clusters += create_chain_cluster_records([[c.id] for c in
+         new_chains if c.cluster_id is None], chains)
+        clusters.update((c.id, c) for c in new_clusters)
+
+    # Work out fingerprints of new sites, and of any sites grouped before
+    # fingerprints were saved
+    print("Grouping new zinc sites based on associated chains...")
+    add_fingerprints_to_sites(ZincSite.objects.filter(
+     Q(group=None) | Q(fingerprint="")
+    ), sites, chains)
+    group_fingerprints = {site.fingerprint: groups[site.group_id]
+     for site in sites.values() if site.group_id is not None}
+
+    # Add new sites to existing groups, or create new groups for them
+    site_clusters = get_site_clusters(
+     [site for site in sites.values() if site.group_id is None]
+    )
+    print(f"Grouping {sum(map(len, site_clusters.values()))} new sites")
+    new_clusters, changed = [], set()
+    for fingerprint, cluster_sites in tqdm(site_clusters.items()):
+        if fingerprint in group_fingerprints:
+            group = group_fingerprints[fingerprint]
+            for site in cluster_sites: site.group_id = group.id
+            changed.add(group.id)
+        else:
+            new_clusters.append(cluster_sites)
+    for group in create_group_records(new_clusters, index):
+        groups[group.id] = group
+
+    # Groups which have gained sites, or whose representative has been
+    # removed, need updating
+    group_sites = {}
+    for site in sites.values():
+        group_sites.setdefault(site.group_id, []).append(site)
+    for id, group in groups.items():
+        if id in changed or not any(s.representative for s in group_sites[id]):
+            update_group_record(group, group_sites[id], index)
+    return clusters, groups
+
+
+def cluster_coarser_levels(backend, directory, index, chains, sites, clusters, groups):
+    """Clusters the chain clusters at the first sequence identity into larger
+    clusters at each lower sequence identity in turn, with each level made from
+    the representatives of the level before. Site groups are grouped the same
+    way. The chains, sites, clusters and groups are given as dicts of IDs to
+    records, and the new clusters and groups are added to the latter two. Any
+    clusters and groups already at those identities are left out, temporary
+    files are saved in the directory given, and groups are described using the
+    PdbIndex given."""
+
+    from factories import create_parent_cluster_records
+    from factories import create_parent_group_records
+
+    # Cluster the representatives of each level to make the next
+    fasta = os.path.join(directory, "representatives.fasta")
+    representatives = get_cluster_representatives(chains)
+    children = {c.id: clusters[id] for id, c in representatives.items()}
+    chains = {c.id: c for c in representatives.values()}
+    for cluster in clusters.values(): cluster.parent_id = None
+    level_parents = []
+    for identity in SEQUENCE_IDENTITIES[1:]:
+        save_chains_fasta(Chain.objects.order_by("id"), fasta, set(children))
+        clustered = backend.cluster(fasta, identity)
+        ids = set(id for cluster in clustered for id in cluster)
+        clustered += [[id] for id in children if id not in ids]
+        children, parents = create_parent_cluster_records(
+         clustered, chains, children, identity
+        )
+        clusters.update((c.id, c) for c in children.values())
+        level_parents.append(parents)
+        print(f"Clustered chains into {len(children)} clusters ({identity * 100}% sequence identity)")
+
+    # Group the groups of each level to make the next
+    group_sites = {}
+    for site in sites.values():
+        group_sites.setdefault(site.group_id, []).append(site)
+    for group in groups.values(): group.parent_id = None
+    level = [((groups[id], s), s[0].fingerprint) for id, s in group_sites.items()]
+    for identity, parents in zip(SEQUENCE_IDENTITIES[1:], level_parents):
+        grouped = {}
+        for group, fingerprint in level:
+            grouped.setdefault(
+             get_coarser_fingerprint(fingerprint, parents), []
+            ).append(group)
+        level = list(zip(create_parent_group_records(
+         grouped.values(), identity, index
+        ), grouped.keys()))
+        groups.update((group.id, group) for (group, s), f in level)
+        print(f"Grouped sites into {len(level)} groups ({identity * 100}% sequence identity)")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+     "--incremental", action="store_true",
+     help="keep existing clusters and only cluster new chains and sites"
+    )
+    parser.add_argument(
+     "--backend", choices=sorted(BACKENDS), default="cd-hit",
+     help="what to cluster chains with"
+    )
+    args = parser.parse_args()
     print()
-    main()
+    main(incremental=args.incremental, backend=args.backend)
     print()
\ No newline at end of file
@@ -0,0 +1,69 @@
+"""Contains a class for holding what is known about a structure while it is
+being processed."""
+
+from spatial import AtomIndex
+
+class StructureContext:
+    """Holds a PDB and the model chosen from it, and works out facts about
+    them (their metals, whether they are skeletons, a spatial index etc.) the
+    first time each is asked for. Each fact is cached, so that no helper has to
+    walk the whole model again to get it."""
+
+    def __init__(self, pdb, model):
+        self.pdb, self.model = pdb, model
+        self._cache = {}
+
+
+    def _get(self, key, func):
+        if key not in self._cache: self._cache[key] = func()
+        return self._cache[key]
+
+
+    @property
+    def metals(self):
+        """The metal atoms in the model."""
+
+        return self._get("metals", lambda: list(self.model.atoms(is_metal=True)))
+
+
+    @property
+    def zincs(self):
+        """The zinc atoms in the model."""
+
+        return self._get("zincs", lambda: [
+         a for a in self.metals if a.element == "ZN"
+        ])
+
+
+    @property
+    def zinc_ids(self):
+        """The IDs of the zinc atoms in the model."""
+
+        return self._get("zinc_ids", lambda: set(a.id for a in self.zincs))
+
+
+    @property
+    def skeleton(self):
+        """Whether the model contains nothing but backbone atoms."""
+
+        from utilities import model_is_skeleton
+        return self._get("skeleton", lambda: model_is_skeleton(self.model))
+
+
+    @property
+    def pdb_skeleton(self):
+        """Whether the PDB's own model (the asymmetric unit) contains nothing but
+        backbone atoms."""
+
+        if self.model is self.pdb.model: return self.skeleton
+        from utilities import model_is_skeleton
+        return self._get(
+         "pdb_skeleton", lambda: model_is_skeleton(self.pdb.model)
+        )
+
+
+    @property
+    def index(self):
+        """A spatial index of the model's atoms."""
+
+        return self._get("index", lambda: AtomIndex(self.model))
@@ -0,0 +1,88 @@
+"""Contains functions for describing the atomium objects a PDB is analysed with
+as plain data - dicts, lists and tuples of strings and numbers. Analyses are
+sent back from worker processes by pickling them, and atomium links every
+residue to the next, so pickling the objects themselves recurses too deeply
+once a chain is a few hundred residues long."""
+
+import atomium
+from sites import create_site_family
+
+def describe_pdb(pdb):
+    """Describes an atomium File with the values its Pdb record needs, keyed
+    by field name."""
+
+    return {
+     "id": pdb.code, "rvalue": pdb.rvalue, "classification": pdb.classification,
+     "deposition_date": pdb.deposition_date, "organism": pdb.source_organism,
+     "expression_system": pdb.expression_system, "technique": pdb.technique,
+     "keywords": ", ".join(pdb.keywords) if pdb.keywords else "",
+     "title": pdb.title, "resolution": pdb.resolution
+    }
+
+
+def get_atom_key(atom, keys):
+    """Gets the key an atom is referred to by in an analysis, from a dict of
+    the atoms given keys so far, giving it the next one if it has none yet.
+    Atom IDs can repeat within an assembly, so they can't be used instead."""
+
+    return keys.setdefault(atom, len(keys))
+
+
+def describe_atom(atom, keys):
+    """Describes an atom, along with its key in the analysis."""
+
+    return {
+     "key": get_atom_key(atom, keys), "id": atom.id, "element": atom.element,
+     "name": atom.name, "location": tuple(atom.location)
+    }
+
+
+def describe_metal(atom):
+    """Describes a metal atom, along with the residue and chain it is in."""
+
+    return {
+     "id": atom.id, "element": atom.element, "name": atom.name,
+     "location": tuple(atom.location), "residue_id": atom.het.id,
+     "residue_name": atom.het.name, "chain_id": atom.chain.id
+    }
+
+
+def describe_residue(residue, keys):
+    """Describes a residue or ligand, with its atoms in ID order. Residues in
+    chains get a signature of their own name and their neighbours' names."""
+
+    signature = []
+    polymer = isinstance(residue, atomium.Residue)
+    if polymer:
+        if residue.previous: signature = [residue.previous.name.lower()]
+        signature.append(residue.name)
+        if residue.next: signature.append(residue.next.name.lower())
+    return {
+     "id": residue.id, "name": residue.name, "chain_id": residue.chain.id,
+     "polymer": polymer, "signature": ".".join(signature),
+     "atoms": [describe_atom(atom, keys)
+      for atom in sorted(residue.atoms(), key=lambda a: a.id)]
+    }
+
+
+def describe_site(site, keys):
+    """Describes a site dict - its metals (in ID order) with the keys of their
+    liganding atoms, its residues and the chains they are in, the sequences of
+    those chains, and its stabilising residues and the atom keys of the
+    contacts they make."""
+
+    return {
+     "family": create_site_family(site["residues"]),
+     "metals": [(describe_metal(metal), [get_atom_key(atom, keys)
+      for atom in sorted(atoms, key=lambda a: a.id)])
+       for metal, atoms in sorted(site["metals"].items(), key=lambda m: m[0].id)],
+     "residues": [describe_residue(residue, keys)
+      for residue in sorted(site["residues"], key=lambda r: r.id)],
+     "chains": [chain.id for chain in sorted(site["chains"], key=lambda c: c.id)],
+     "sequences": site["sequences"],
+     "second_residues": [describe_residue(residue, keys)
+      for residue in site["second_residues"]],
+     "stabiliser_contacts": [(get_atom_key(primary, keys),
+      get_atom_key(secondary, keys))
+       for primary, secondary in site["stabiliser_contacts"]]
+    }
@@ -1,179 +1,382 @@
 """Contains functions for building objects in the database."""
 
+from uuid import uuid4
+from itertools import groupby
+from operator import itemgetter
+from django.db import connection, transaction
+from django.db.models import Max
 from core.models import *
-from chains import get_chain_sequence
-from sites import get_group_information, create_site_family
-
-def create_pdb_record(pdb, assembly_id):
-    """Creates a Pdb record from an atomium File and an assembly ID."""
-
-    from utilities import model_is_skeleton
-    return Pdb.objects.create(
-     id=pdb.code, rvalue=pdb.rvalue, classification=pdb.classification,
-     deposition_date=pdb.deposition_date, organism=pdb.source_organism,
-     expression_system=pdb.expression_system, technique=pdb.technique,
-     keywords=", ".join(pdb.keywords) if pdb.keywords else "", title=pdb.title,
-     resolution=pdb.resolution, skeleton=model_is_skeleton(pdb.model),
-     assembly=assembly_id
-    )
+from sites import get_group_information
+from chains import get_age_key
+
+CLUSTERING_FIELDS = {
+ ChainCluster: ["id", "identity", "parent"],
+ Group: ["id", "family", "keywords", "classifications", "identity", "parent"],
+ Chain: ["id", "cluster"],
+ ZincSite: ["id", "group", "representative", "fingerprint"]
+}
+
+class RecordWriter:
+    """Collects the records for a PDB in memory so that they can be saved with
+    one query per table, rather than one query per record.
+
+    Primary keys are given out as records are added, in the order they are
+    added, so that records can refer to each other before any of them have
+    been saved."""
+
+    MODELS = [
+     ManifestEntry, Pdb, Chain, ZincSite, Metal, ChainInteraction, Residue,
+     Atom, CoordinateBond, StabilisingBond
+    ]
+
+    def __init__(self):
+        self.records = {Model: [] for Model in self.MODELS}
+        self.next_ids = {}
+
+
+    def add(self, record):
+        """Adds an unsaved record to the writer, giving it a primary key if
+        the database would normally do so, and returns it."""
+
+        Model = record.__class__
+        if record.pk is None:
+            if Model not in self.next_ids:
+                current_max = Model.objects.aggregate(Max("id"))["id__max"]
+                self.next_ids[Model] = (current_max or 0) + 1
+            record.pk = self.next_ids[Model]
+            self.next_ids[Model] += 1
+        self.records[Model].append(record)
+        return record
+
+
+    def save(self):
+        """Saves all the records collected so far, with one bulk_create per
+        table, in an order that satisfies all foreign keys."""
 
+        for Model in self.MODELS:
+            if self.records[Model]:
+                Model.objects.bulk_create(self.records[Model])
+            self.records[Model] = []
 
-def create_metal_record(atom, pdb_record, site_record=None, omission=None):
-    """Creates a Metal record. You specify a Pdb record, and optionally either
-    a Site record (if part of one) or a reason for omission (if not)."""
 
-    residue = atom.het
-    numeric_id, insertion = residue.id.split(".")[1], ""
+def create_pdb_record(writer, pdb, assembly_id, skeleton):
+    """Creates a Pdb record from a description of an atomium File, an assembly
+    ID, and whether the File's model is a skeleton."""
+
+    return writer.add(Pdb(**pdb, skeleton=skeleton, assembly=assembly_id))
+
+
+def create_metal_record(writer, metal, pdb_record, site_record=None, omission=None):
+    """Creates a Metal record from a description of a metal atom. You specify a
+    Pdb record, and optionally either a Site record (if part of one) or a
+    reason for omission (if not)."""
+
+    numeric_id, insertion = metal["residue_id"].split(".")[1], ""
     while not numeric_id[-1].isdigit():
         insertion += numeric_id[-1]
         numeric_id = numeric_id[:-1]
     numeric_id = int(numeric_id)
-    x, y, z = atom.location
-    return Metal.objects.create(
-     atomium_id=atom.id, element=atom.element, name=atom.name, x=x, y=y, z=z, 
-     residue_number=numeric_id, insertion_code=insertion,
-     chain_id=atom.chain.id, residue_name=residue.name,
+    x, y, z = metal["location"]
+    return writer.add(Metal(
+     atomium_id=metal["id"], element=metal["element"], name=metal["name"],
+     x=x, y=y, z=z, residue_number=numeric_id, insertion_code=insertion,
+     chain_id=metal["chain_id"], residue_name=metal["residue_name"],
      pdb=pdb_record, site=site_record, omission_reason=omission
-    )
+    ))
 
 
-def create_chain_record(chain, pdb_record, sequence):
-    """Creates a Chain record from an atomium Chain, a Pdb record, and a
+def create_chain_record(writer, chain_id, pdb_record, sequence):
+    """Creates a Chain record from an atomium chain ID, a Pdb record, and a
     sequence."""
 
-    return Chain.objects.create(
-     id=f"{pdb_record.id}{chain.id}", pdb=pdb_record,
-     sequence=sequence, atomium_id=chain.id
-    )
+    return writer.add(Chain(
+     id=f"{pdb_record.id}{chain_id}", pdb=pdb_record,
+     sequence=sequence, atomium_id=chain_id
+    ))
 
 
-def create_site_record(site_dict, pdb_record, index, chains_dict):
-    """Creates a ZincSite record and all its sub-components from a dictionary
-    representing its metals, residues and chains. The ID will be created from
-    the index provided, and the chain information from the chain dictionary
-    provided."""
+def create_site_record(writer, site_dict, pdb_record, index, chains_dict):
+    """Creates a ZincSite record and all its sub-components from a description
+    of its metals, residues, chains, chain interaction sequences and
+    stabilising contacts. The ID will be created from the index provided, and
+    the chain information from the chain dictionary provided."""
 
     # Create site record itself
-    residue_names = set([f".{r.name}." for r in site_dict["residues"]])
+    residue_names = set([f".{r['name']}." for r in site_dict["residues"]])
     residue_names = sorted(list(residue_names))
-    site_record = ZincSite.objects.create(
-     id=f"{pdb_record.id}-{index}",
-     family=create_site_family(site_dict["residues"]), pdb=pdb_record,
-     residue_names="".join(residue_names)
-    )
+    site_record = writer.add(ZincSite(
+     id=f"{pdb_record.id}-{index}", family=site_dict["family"],
+     pdb=pdb_record, residue_names="".join(residue_names)
+    ))
 
     # Create metals
     metals_dict = {}
-    for metal in sorted(site_dict["metals"].keys(), key=lambda m: m.id):
-        metals_dict[metal.id] = create_metal_record(metal, pdb_record, site_record)
+    for metal, atoms in site_dict["metals"]:
+        metals_dict[metal["id"]] = create_metal_record(
+         writer, metal, pdb_record, site_record
+        )
     
     # Create chain interactions
-    for chain in sorted(site_dict["chains"], key=lambda c: c.id):
-        sequence = get_chain_sequence(chain, site_dict["residues"])
+    for chain_id in site_dict["chains"]:
         create_chain_interaction_record(
-         chains_dict[chain.id], site_record, sequence
+         writer, chains_dict[chain_id], site_record,
+         site_dict["sequences"][chain_id]
         )
     
     # Create residue records
     atoms_dict = {}
-    for res in sorted(site_dict["residues"], key=lambda r: r.id):
-        chain_record = chains_dict[res.chain.id] if isinstance(res, atomium.Residue) else None
-        create_residue_record(res, site_record, atoms_dict, chain_record)
+    for res in site_dict["residues"]:
+        chain_record = chains_dict[res["chain_id"]] if res["polymer"] else None
+        create_residue_record(writer, res, site_record, atoms_dict, chain_record)
     
     # Add secondary residues
-    second_residues,  stabiliser_contacts = set(), set()
-    for residue in site_dict["residues"]:
-        for atom in residue.atoms():
-            nearby = atom.nearby_atoms(3)
-            for nearby_atom in nearby:
-                if isinstance(nearby_atom.het, atomium.Residue)\
-                 and nearby_atom.het not in site_dict["residues"]:
-                    second_residues.add(nearby_atom.het)
-                    stabiliser_contacts.add((atom, nearby_atom))
-    for res in second_residues:
-        create_residue_record(res, site_record, atoms_dict, primary=False)
+    for res in site_dict["second_residues"]:
+        create_residue_record(
+         writer, res, site_record, atoms_dict, primary=False
+        )
     
     # Create bond records
-    for metal, atoms in sorted(site_dict["metals"].items(), key=lambda a: a[0].id):
-        for atom in sorted(atoms, key=lambda a: a.id):
-            CoordinateBond.objects.create(
-             metal=metals_dict[metal.id], atom=atoms_dict[atom]
-            )
-    for primary, secondary in stabiliser_contacts:
-        StabilisingBond.objects.create(
+    for metal, atoms in site_dict["metals"]:
+        for atom in atoms:
+            writer.add(CoordinateBond(
+             metal=metals_dict[metal["id"]], atom=atoms_dict[atom]
+            ))
+    for primary, secondary in site_dict["stabiliser_contacts"]:
+        writer.add(StabilisingBond(
          primary_atom=atoms_dict[primary], secondary_atom=atoms_dict[secondary]
-        )
+        ))
     return site_record
 
 
-def create_chain_interaction_record(chain_record, site_record, sequence):
+def create_chain_interaction_record(writer, chain_record, site_record, sequence):
     """Creates a ChainInteraction record from the information provided."""
 
-    return ChainInteraction.objects.create(
+    return writer.add(ChainInteraction(
      sequence=sequence, chain=chain_record, site=site_record
-    )
+    ))
 
 
-def create_residue_record(residue, site_record, atoms_dict, chain_record=None, primary=True):
-    """Creates a Residue record along with its atoms, from information given. A
-    dictionary of atoms must be given to make coordinate bonds later."""
+def create_residue_record(writer, residue, site_record, atoms_dict, chain_record=None, primary=True):
+    """Creates a Residue record along with its atoms, from a description of a
+    residue. A dictionary of atom keys to atoms must be given to make
+    coordinate bonds later."""
 
-    numeric_id, insertion = residue.id.split(".")[1], ""
+    numeric_id, insertion = residue["id"].split(".")[1], ""
     while not numeric_id[-1].isdigit():
         insertion += numeric_id[-1]
         numeric_id = numeric_id[:-1]
     numeric_id = int(numeric_id)
-    signature = []
-    if isinstance(residue, atomium.Residue):
-        if residue.previous: signature = [residue.previous.name.lower()]
-        signature.append(residue.name)
-        if residue.next: signature.append(residue.next.name.lower())
-    signature = ".".join(signature)
-    residue_record = Residue.objects.create(
-     residue_number=numeric_id, chain_identifier=residue.chain.id,
-     insertion_code=insertion, chain_signature=signature, primary=primary,
-     name=residue.name, chain=chain_record, site=site_record, atomium_id=residue.id
-    )
-    for atom in sorted(residue.atoms(), key=lambda a: a.id):
-        atoms_dict[atom] = create_atom_record(atom, residue_record)
+    residue_record = writer.add(Residue(
+     residue_number=numeric_id, chain_identifier=residue["chain_id"],
+     insertion_code=insertion, chain_signature=residue["signature"],
+     primary=primary, name=residue["name"], chain=chain_record,
+     site=site_record, atomium_id=residue["id"]
+    ))
+    for atom in residue["atoms"]:
+        atoms_dict[atom["key"]] = create_atom_record(writer, atom, residue_record)
     return residue_record
 
 
-def create_atom_record(atom, residue_record):
-    """Creates an Atom record from the information provided."""
+def create_atom_record(writer, atom, residue_record):
+    """Creates an Atom record from a description of an atom."""
+
+    x, y, z = atom["location"]
+    return writer.add(Atom(
+     atomium_id=atom["id"], name=atom["name"], x=x, y=y, z=z,
+     element=atom["element"], residue=residue_record
+    ))
 
-    x, y, z = atom.location
-    return Atom.objects.create(
-     atomium_id=atom.id, name=atom.name, x=x, y=y, z=z,
-     element=atom.element, residue=residue_record
-    )
 
+def get_oldest_ids(Model, clusters):
+    """Takes lists of the IDs of Chain or ZincSite records, and gets the ID in
+    each list whose PDB was deposited first, in one query - PDBs with no date
+    come last, and ties go to the lowest ID, as with get_age_key. The IDs are
+    put in a temporary table, which is read back sorted by cluster and then by
+    age, and the IDs are returned in the same order as the lists."""
 
-def create_chain_cluster_record(chain_ids, dates):
-    """Creates a ChainCluster record from the information provided. All chains
-    will be updated as required."""
+    quote = connection.ops.quote_name
+    table = quote(f"{Model._meta.db_table}_members_{uuid4().hex}")
+    oldest = {n: ids[0] for n, ids in enumerate(clusters) if len(ids) == 1}
+    members = [(n, id) for n, ids in enumerate(clusters)
+     if len(ids) > 1 for id in ids]
+    if members:
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TEMP TABLE {table} (cluster INTEGER, id)")
+            try:
+                cursor.executemany(
+                 f"INSERT INTO {table} VALUES (%s, %s)", members
+                )
+                pdb_column = quote(Model._meta.get_field("pdb").column)
+                cursor.execute(
+                 f"SELECT m.cluster, m.id FROM {table} m "
+                 f"JOIN {quote(Model._meta.db_table)} r ON r.id = m.id "
+                 f"JOIN {quote(Pdb._meta.db_table)} p ON p.id = r.{pdb_column} "
+                 f"ORDER BY m.cluster, p.deposition_date IS NULL, "
+                 f"p.deposition_date, m.id"
+                )
+                for n, rows in groupby(cursor.fetchall(), key=itemgetter(0)):
+                    oldest[n] = next(rows)[1]
+            finally:
+                cursor.execute(f"DROP TABLE {table}")
+    return [oldest[n] for n in range(len(clusters))]
 
-    dates = [dates[id] for id in chain_ids]
-    id = chain_ids[dates.index(min(dates))]
-    cluster_object = ChainCluster.objects.create(id=id)
-    for chain_id in chain_ids:
-        chain = Chain.objects.get(id=chain_id)
-        chain.cluster = cluster_object
-        chain.save()
 
+def create_chain_cluster_records(clusters, chains):
+    """Creates ChainCluster records from lists of chain IDs, each one named
+    after its oldest chain, and puts the chains in them. The chains are given
+    as a dict of IDs to Chain records, and nothing is saved - the new clusters
+    are returned."""
 
-def create_group_record(sites):
-    """Creates a Group record from the information provided. All relevant sites
-    will be updated."""
+    cluster_records = []
+    for chain_ids, oldest in zip(clusters, get_oldest_ids(Chain, clusters)):
+        cluster = ChainCluster(id=oldest)
+        cluster_records.append(cluster)
+        for id in chain_ids: chains[id].cluster_id = cluster.id
+    return cluster_records
 
-    oldest = sorted(sites, key=lambda s: s.date)[0]
-    keywords, classifications = get_group_information(sites)
-    group = Group.objects.create(
-     id=oldest.id, family=sites[0].family,
-     keywords=keywords, classifications=classifications
+
+def create_group_records(clusters, index):
+    """Creates Group records from lists of ZincSite records, each one named
+    after and represented by its oldest site, and puts the sites in them.
+    Nothing is saved - the new groups are returned. A PdbIndex is needed to
+    describe the groups."""
+
+    group_records = []
+    oldest_ids = get_oldest_ids(
+     ZincSite, [[site.id for site in sites] for sites in clusters]
     )
-    for site in sites:
-        site.group = group
-        if site.id == group.id: site.representative = True
-        site.save()
+    for sites, oldest in zip(clusters, oldest_ids):
+        keywords, classifications = get_group_information(sites, index)
+        group = Group(
+         id=oldest, family=sites[0].family,
+         keywords=keywords, classifications=classifications
+        )
+        group_records.append(group)
+        for site in sites:
+            site.group_id, site.representative = group.id, site.id == group.id
+    return group_records
+
+
+def create_parent_cluster_records(clusters, chains, children, identity):
+    """Creates ChainCluster records at a lower sequence identity, from lists of
+    the IDs of chains which represent existing clusters - dicts of these chain
+    IDs to their Chain records, with their dates, and to the clusters' records
+    must be given. Each new cluster is named after its oldest chain and the
+    identity, and becomes the parent of the clusters in it. The chains
+    representing the new clusters are returned in the same form as the
+    clusters, along with a dict of the existing clusters' IDs to their
+    parents' IDs."""
+
+    representatives, parents = {}, {}
+    for chain_ids in clusters:
+        representative = min(chain_ids, key=lambda id: get_age_key(chains[id]))
+        cluster = ChainCluster(
+         id=f"{representative}-{round(identity * 100)}", identity=identity
+        )
+        representatives[representative] = cluster
+        for id in chain_ids:
+            children[id].parent_id = cluster.id
+            parents[children[id].id] = cluster.id
+    return representatives, parents
+
 
+def create_parent_group_records(clusters, identity, index):
+    """Creates Group records at a lower sequence identity, from lists of the
+    existing Group records to go in each one, given with their ZincSite
+    records as (group, sites) tuples. Each new group is named after its oldest
+    site and the identity, and becomes the parent of the groups in it. The new
+    groups are returned in the same form. A PdbIndex is needed to describe the
+    groups."""
+
+    parents = []
+    for children in clusters:
+        sites = [site for group, s in children for site in s]
+        oldest = min(sites, key=get_age_key)
+        keywords, classifications = get_group_information(sites, index)
+        group = Group(
+         id=f"{oldest.id}-{round(identity * 100)}", identity=identity,
+         family=children[0][0].family,
+         keywords=keywords, classifications=classifications
+        )
+        for child, child_sites in children: child.parent_id = group.id
+        parents.append((group, sites))
+    return parents
+
+
+def update_group_record(group, sites, index):
+    """Updates a Group record's information after sites have been added to or
+    removed from it, given the ZincSite records now in it and a PdbIndex. The
+    site the group is named after represents it if it still exists, and
+    otherwise the oldest site in the group does."""
+
+    ids = [site.id for site in sites]
+    representative = group.id if group.id in ids else \
+     min(sites, key=get_age_key).id
+    group.keywords, group.classifications = get_group_information(sites, index)
+    for site in sites: site.representative = site.id == representative
+
+
+def save_clustering(records):
+    """Replaces every chain cluster and site group in the database, and which
+    chains and sites are in them, with those in a dict of models to lists of
+    records - every chain and site must be given.
+
+    The records are first written to temporary shadow tables, named uniquely so
+    that two runs can't share them, and the live tables are then updated from
+    them in one transaction, with a few queries which each work on a whole
+    table. Anything reading the database meanwhile sees the old clustering
+    until the new one is complete, and the old clusters and groups are deleted
+    directly rather than one at a time. If chains or sites have been added or
+    removed since the records were loaded, nothing is changed."""
+
+    quote = connection.ops.quote_name
+    suffix = uuid4().hex
+    tables = {}
+    for Model, fields in CLUSTERING_FIELDS.items():
+        fields = [Model._meta.get_field(field) for field in fields]
+        tables[Model] = (
+         quote(Model._meta.db_table),
+         quote(f"{Model._meta.db_table}_shadow_{suffix}"),
+         [quote(field.column) for field in fields], fields
+        )
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            for Model, (table, shadow, columns, fields) in tables.items():
+                cursor.execute(f"CREATE TEMP TABLE {shadow} AS SELECT "
+                 f"{', '.join(columns)} FROM {table} WHERE 1 = 0")
+                index = quote(f"{Model._meta.db_table}_shadow_{suffix}_id")
+                cursor.execute(
+                 f"CREATE UNIQUE INDEX {index} ON {shadow} ({columns[0]})"
+                )
+                cursor.executemany(
+                 f"INSERT INTO {shadow} ({', '.join(columns)}) VALUES "
+                 f"({', '.join(['%s'] * len(columns))})", [[
+                  field.get_db_prep_save(getattr(record, field.attname), connection)
+                  for field in fields
+                 ] for record in records[Model]]
+                )
+        with transaction.atomic(), connection.cursor() as cursor:
+            for Model in (Chain, ZincSite):
+                table, shadow, columns, fields = tables[Model]
+                id = columns[0]
+                cursor.execute(f"SELECT COUNT(*), COUNT({shadow}.{id}) FROM "
+                 f"{table} LEFT JOIN {shadow} ON {shadow}.{id} = {table}.{id}")
+                if cursor.fetchone() != (len(records[Model]),) * 2:
+                    raise Exception(f"{Model.__name__} records were added or "
+                     "removed while clustering, so it must be run again")
+            for Model in (Group, ChainCluster):
+                table, shadow, columns, fields = tables[Model]
+                cursor.execute(f"DELETE FROM {table}")
+                cursor.execute(f"INSERT INTO {table} ({', '.join(columns)}) "
+                 f"SELECT {', '.join(columns)} FROM {shadow}")
+            for Model in (Chain, ZincSite):
+                table, shadow, columns, fields = tables[Model]
+                id = columns[0]
+                cursor.execute(f"UPDATE {table} SET " + ", ".join(
+                 f"{column} = (SELECT {column} FROM {shadow} "
+                 f"WHERE {shadow}.{id} = {table}.{id})" for column in columns[1:]
+                ) + f" WHERE {id} IN (SELECT {id} FROM {shadow})")
+    finally:
+        with connection.cursor() as cursor:
+            for table, shadow, columns, fields in tables.values():
+                cursor.execute(f"DROP TABLE IF EXISTS {shadow}")
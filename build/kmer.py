@@ -0,0 +1,138 @@
+"""Contains a clusterer which groups sequences by identity without needing any
+external binaries. It works in the same greedy, incremental way as CD-HIT."""
+
+import numpy as np
+from chains import align_sequences, get_word_length
+
+MIN_LENGTH = 11
+
+def read_fasta(path):
+    """Reads a FASTA file written by save_chains_fasta, and returns its sequences
+    as a list of (chain ID, sequence) tuples."""
+
+    sequences = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                sequences.append([line.split("|")[1], ""])
+            elif line and sequences:
+                sequences[-1][1] += line
+    return [tuple(sequence) for sequence in sequences]
+
+
+def get_words(sequence, word_length):
+    """Encodes every word of a given length in a sequence as an integer, and
+    returns the unique ones as a list."""
+
+    codes = np.frombuffer(sequence.upper().encode(), dtype=np.uint8) & 31
+    count = len(codes) - word_length + 1
+    if count < 1: return []
+    words = np.zeros(count, dtype=np.int64)
+    for offset in range(word_length):
+        words = words * 32 + codes[offset:offset + count]
+    return np.unique(words).tolist()
+
+
+def get_identity(sequence1, sequence2):
+    """Aligns two sequences, and returns the fraction of the shorter one's
+    residues which are identical to the residue they are aligned with."""
+
+    align1, align2 = align_sequences(sequence1.upper(), sequence2.upper())
+    identical = sum(1 for a, b in zip(align1, align2) if a == b and a != "-")
+    return identical / min(len(sequence1), len(sequence2))
+
+
+
+class KmerClusterer:
+    """Clusters sequences one at a time. Each sequence joins the cluster whose
+    representative it is most similar to, if that similarity is at or above the
+    sequence identity threshold - otherwise it becomes the representative of a
+    new cluster.
+
+    As with CD-HIT, only representatives which share enough short words with a
+    sequence are aligned with it. Identity is measured over the shorter of the
+    two, which can only differ from the other at so many positions, and each of
+    those can only remove so many of its words, which gives the number of words
+    they must share."""
+
+    def __init__(self, sequence_identity):
+        self.sequence_identity = sequence_identity
+        self.word_length = get_word_length(sequence_identity)
+        self.clusters, self.representatives, self.words = [], [], {}
+        self.word_counts = []
+
+
+    def add_representative(self, id, sequence):
+        """Starts a new cluster with a sequence as its representative."""
+
+        words = get_words(sequence, self.word_length)
+        for word in words:
+            self.words.setdefault(word, []).append(len(self.clusters))
+        self.clusters.append([id])
+        self.representatives.append(sequence)
+        self.word_counts.append(len(words))
+
+
+    def find_cluster(self, sequence):
+        """Gets the index of the cluster a sequence belongs in, or None if it
+        isn't similar enough to any of their representatives."""
+
+        words = get_words(sequence, self.word_length)
+        postings = [self.words[word] for word in words if word in self.words]
+        if not postings: return None
+        shared = np.bincount(
+         np.concatenate(postings), minlength=len(self.clusters)
+        )
+        indices = np.nonzero(shared)[0]
+        lengths = np.minimum(
+         [len(self.representatives[i]) for i in indices], len(sequence)
+        )
+        counts = np.minimum([self.word_counts[i] for i in indices], len(words))
+        differences = np.ceil((1 - self.sequence_identity) * lengths)
+        required = np.maximum(counts - differences * self.word_length, 1)
+        candidates = indices[shared[indices] >= required]
+        best, best_identity = None, self.sequence_identity
+        for index in candidates[np.argsort(-shared[candidates], kind="stable")]:
+            identity = get_identity(self.representatives[index], sequence)
+            if identity > best_identity or (
+             best is None and identity == best_identity
+            ):
+                best, best_identity = index, identity
+        return best
+
+
+    def add(self, id, sequence):
+        """Adds a sequence to the cluster it belongs in, or to a new one."""
+
+        index = self.find_cluster(sequence)
+        if index is None:
+            self.add_representative(id, sequence)
+        else:
+            self.clusters[index].append(id)
+
+
+
+def cluster_sequences(sequences, sequence_identity):
+    """Clusters (ID, sequence) tuples, longest first, and returns the clusters
+    as lists of IDs. Sequences too short to cluster are left out, as CD-HIT
+    leaves them out."""
+
+    clusterer = KmerClusterer(sequence_identity)
+    for id, sequence in sorted(sequences, key=lambda s: -len(s[1])):
+        if len(sequence) >= MIN_LENGTH: clusterer.add(id, sequence)
+    return clusterer.clusters
+
+
+def match_sequences(representatives, sequences, sequence_identity):
+    """Compares (ID, sequence) tuples with the representatives of existing
+    clusters, and returns each representative which sequences matched, along
+    with those sequences, as lists of IDs."""
+
+    clusterer = KmerClusterer(sequence_identity)
+    for id, sequence in representatives: clusterer.add_representative(id, sequence)
+    for id, sequence in sequences:
+        if len(sequence) >= MIN_LENGTH:
+            index = clusterer.find_cluster(sequence)
+            if index is not None: clusterer.clusters[index].append(id)
+    return [cluster for cluster in clusterer.clusters if len(cluster) > 1]
@@ -1,9 +1,11 @@
 """Contains functions for processing binding sites and groups of atoms."""
 
 import math
+import numpy as np
+from scipy.spatial import cKDTree
 from tqdm import tqdm
+from itertools import groupby
 from collections import Counter
-from itertools import combinations
 import atomium
 from django.db.models import F
 
@@ -19,25 +21,36 @@ def remove_duplicate_atoms(atoms):
     elements = set([m.element for m in atoms])
     for element in elements:
         relevant_atoms = [m for m in atoms if m.element == element]
-        unique_relevant = set()
-        for r in relevant_atoms:
-            for u in unique_relevant:
-                if r.distance_to(u) < 1:
-                    break
-            else:
-                unique_relevant.add(r)
-        new_set.update(unique_relevant)
+        locations = np.array([a.location for a in relevant_atoms])
+        neighbours = cKDTree(locations).query_ball_point(locations, 1)
+        unique = [False] * len(relevant_atoms)
+        for index, indices in enumerate(neighbours):
+            unique[index] = not any(unique[i] and np.linalg.norm(
+             locations[index] - locations[i]
+            ) < 1 for i in indices if i != index)
+        new_set.update(a for a, u in zip(relevant_atoms, unique) if u)
     return new_set
 
 
-def get_atom_liganding_atoms(metal):
-    """Takes an atom and gets all non-metal, non-carbon, non-hydrogen atoms
-    within 3Å. It then goes through all these atoms, starting with the closest,
-    and if any of them have a coordination bond angle with a closer atom of
-    less than 45 degrees, it is discarded."""
+def get_liganding_atoms(metals, index):
+    """Takes some metal atoms and a spatial index of the model they are in, and
+    returns a dict of each metal and its liganding atoms. All the metals'
+    neighbours are looked up in one query."""
+
+    metals = list(metals)
+    nearby_atoms = index.nearby_atoms(metals, 3)
+    return {metal: get_atom_liganding_atoms(metal, nearby)
+     for metal, nearby in zip(metals, nearby_atoms)}
+
+
+def get_atom_liganding_atoms(metal, nearby_atoms):
+    """Takes an atom and the atoms within 3Å of it, and gets all the non-metal,
+    non-carbon, non-hydrogen atoms among them. It then goes through all these
+    atoms, starting with the closest, and if any of them have a coordination
+    bond angle with a closer atom of less than 45 degrees, it is discarded."""
 
-    kwargs = {"cutoff": 3, "is_metal": False}
-    nearby_atoms = [a for a in metal.nearby_atoms(**kwargs) if a.element not in "CH"]
+    nearby_atoms = [a for a in nearby_atoms
+     if not a.is_metal and a.element not in "CH"]
     nearby_atoms = remove_duplicate_atoms(nearby_atoms)
     nearby_atoms = sorted(nearby_atoms, key=lambda a: a.distance_to(metal))
     liganding = []
@@ -66,18 +79,32 @@ def remove_salt_metals(metals):
 
 
 def merge_metal_groups(sites):
-    """Takes a dictionary in which the keys are metal atoms and the values are
-    the set of residues that bind to them.
-    It then creates a list of sites from this, where each site is a dict
-    object with metals and residues. Two metals and their residues will be
-    merged together if they share residues."""
-
-    while not check_sites_have_unique_residues(sites):
-        for site1, site2 in combinations(sites, 2):
-            if get_site_residues(site1).intersection(get_site_residues(site2)):
-                site1["metals"].update(site2["metals"])
-                sites.remove(site2)
-                break
+    """Takes a list of sites, each a dict with a metals dict mapping metal
+    atoms to their liganding atoms, and merges together those that share
+    residues (directly or through other sites). Each merged site keeps the
+    position of its earliest member in the list.
+
+    Residues are indexed to the first site they appear in once, and sites are
+    joined using a disjoint-set, so this takes a single pass over the sites."""
+
+    parents = list(range(len(sites)))
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+    residue_sites = {}
+    for index, site in enumerate(sites):
+        for residue in get_site_residues(site):
+            if residue in residue_sites:
+                root1, root2 = find(residue_sites[residue]), find(index)
+                parents[max(root1, root2)] = min(root1, root2)
+            else:
+                residue_sites[residue] = index
+    for index, site in enumerate(sites):
+        if find(index) != index:
+            sites[find(index)]["metals"].update(site["metals"])
+    sites[:] = [site for index, site in enumerate(sites) if find(index) == index]
     return sites
 
 
@@ -110,12 +137,27 @@ def get_site_chains(site):
     """Takes a dict with residue information, and gets all the chains associated
     with the *polymer* residues."""
 
-    site_chains = set()
+    site_chains = {}
     for res in site["residues"]:
         if isinstance(res, atomium.Residue):
-            if res.chain.id not in [c.id for c in site_chains]:
-                site_chains.add(res.chain)
-    return site_chains
+            site_chains.setdefault(res.chain.id, res.chain)
+    return set(site_chains.values())
+
+
+def get_site_stabilisers(site, index):
+    """Takes a dict with residue information, and a spatial index of the model,
+    and gets all the polymer residues that are near to, but not part of, the
+    site - along with the atom pairs that make those contacts."""
+
+    second_residues, stabiliser_contacts = set(), set()
+    atoms = [atom for residue in site["residues"] for atom in residue.atoms()]
+    for atom, nearby in zip(atoms, index.nearby_atoms(atoms, 3)):
+        for nearby_atom in nearby:
+            if isinstance(nearby_atom.het, atomium.Residue)\
+             and nearby_atom.het not in site["residues"]:
+                second_residues.add(nearby_atom.het)
+                stabiliser_contacts.add((atom, nearby_atom))
+    return second_residues, stabiliser_contacts
 
 
 def create_site_family(residues):
@@ -126,49 +168,117 @@ def create_site_family(residues):
     return "".join([f"{c}{codes.count(c)}" for c in sorted(set(codes))])
 
 
-def add_fingerprint_to_site(site):
-    """Adds a fingerprint property to a ZincSite record based on its chains'
-    cluster IDs and chain signature."""
-
-    site_chain_clusters = set([
-     str(res.chain.cluster.id) for res in site.residue_set.filter(primary=True) if res.chain_signature
-    ])
-    site.fingerprint = "_".join(sorted(site_chain_clusters)) + "__" + "_".join(
-     [str(res.chain_signature) for res in site.residue_set.exclude(chain_signature="")]
+def add_fingerprints_to_sites(sites, records, chains):
+    """Works out the fingerprints of a queryset of ZincSite records, based on
+    their chains' clusters and chain signatures. Rather than being saved, they
+    are given to the matching records in a dict of site IDs to ZincSite
+    records, and the chains' clusters are taken from a dict of chain IDs to
+    Chain records, so that neither needs to be in the database yet. All the
+    residues needed are fetched in one query, in site order."""
+
+    from core.models import Residue
+    for id in sites.values_list("id", flat=True).iterator():
+        records[id].fingerprint = "__"
+    residues = Residue.objects.filter(site__in=sites.values("id")).exclude(
+     chain_signature=""
+    ).order_by("site", "residue_number", "id").values_list(
+     "site", "primary", "chain", "chain_signature"
     )
+    for site_id, rows in groupby(residues.iterator(), key=lambda r: r[0]):
+        clusters, signatures = set(), []
+        for site_id, primary, chain, signature in rows:
+            if primary:
+                clusters.add(str(chains[chain].cluster_id if chain else None))
+            signatures.append(signature)
+        records[site_id].fingerprint = "_".join(
+         sorted(clusters)) + "__" + "_".join(signatures)
 
 
 def get_site_clusters(sites):
-    """Clusters sites based on their signatures and returns them as a dict."""
+    """Clusters ZincSite records based on their fingerprints and returns them
+    as a dict. The sites are sorted by fingerprint, so that each cluster comes
+    in one run."""
+
+    return {fingerprint: list(sites) for fingerprint, sites in groupby(
+     sorted(sites, key=lambda s: (s.fingerprint, s.id)),
+     key=lambda s: s.fingerprint
+    )}
+
+
+def get_coarser_fingerprint(fingerprint, parents):
+    """Takes a site fingerprint, and a dict of chain cluster IDs to the IDs of
+    the clusters they are nested in, and returns the fingerprint which the site
+    has when those clusters are used instead."""
+
+    clusters, signatures = fingerprint.split("__", 1)
+    clusters = set(parents.get(id, id) for id in clusters.split("_") if id)
+    return "_".join(sorted(clusters)) + "__" + signatures
+
+
+class PdbIndex:
+    """Holds what is needed to describe groups for every PDB in the database,
+    fetched with one query. Every three-character fragment of their titles is
+    indexed, so that the PDBs whose titles contain a keyword can be found
+    without checking every title, and the PDBs found for each keyword are
+    remembered."""
+
+    def __init__(self):
+        from core.models import Pdb
+        self.pdbs, self.trigrams, self.matches = {}, {}, {}
+        for id, title, keywords, classification in Pdb.objects.values_list(
+         "id", "title", "keywords", "classification"
+        ).iterator():
+            self.pdbs[id] = (title, keywords, classification)
+            for trigram in get_trigrams(title):
+                self.trigrams.setdefault(trigram, set()).add(id)
+
+
+    def get_title_matches(self, keyword):
+        """Gets the IDs of the PDBs whose titles contain a keyword."""
+
+        if keyword not in self.matches:
+            trigrams = get_trigrams(keyword)
+            if trigrams:
+                postings = sorted(
+                 [self.trigrams.get(trigram, set()) for trigram in trigrams],
+                 key=len
+                )
+                ids = set.intersection(*postings)
+            else:
+                ids = self.pdbs.keys()
+            self.matches[keyword] = {
+             id for id in ids if keyword in self.pdbs[id][0]
+            }
+        return self.matches[keyword]
 
-    unique_sites = {}
-    for site in sites:
-        try:
-            unique_sites[site.fingerprint].append(site)
-        except: unique_sites[site.fingerprint] = [site]
-    return unique_sites
 
 
-def get_group_information(sites):
-    """Takes a list of ZincSite records and tries to extract information they
-    have in common."""
+def get_trigrams(text):
+    """Gets the set of three-character fragments in some text."""
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_group_information(sites, index):
+    """Takes a list of ZincSite records and a PdbIndex, and tries to extract
+    information the sites' PDBs have in common."""
     
-    pdbs = list(set([site.pdb for site in sites]))
+    pdbs = sorted(set(site.pdb_id for site in sites))
     classifications = []
     keywords = []
     for pdb in pdbs:
-        classifications.append(pdb.classification.upper())
-        keywords += pdb.keywords.upper().split(", ")
+        title, pdb_keywords, classification = index.pdbs[pdb]
+        classifications.append(classification.upper())
+        keywords += pdb_keywords.upper().split(", ")
     classifications = Counter(classifications)
     keywords = Counter(keywords)
     title_keywords = {}
     bad_keywords = ["INHIBITOR", "ZINC", "ZINC ENZYME"]
+    pdb_set = set(pdbs)
     for keyword in keywords:
         if keyword not in bad_keywords and not keyword.isdigit():
-            count = 0
-            for pdb in pdbs:
-                if keyword in pdb.title: count += 1
-            title_keywords[keyword] = count
+            matches = index.get_title_matches(keyword)
+            title_keywords[keyword] = len(pdb_set & matches)
     title_keywords = list(reversed(sorted(title_keywords.items(), key=lambda k: k[1])))
     cutoff = int(len(pdbs) * 0.25)
     classifications = [c for c, n in classifications.items() if n >= cutoff]
@@ -0,0 +1,29 @@
+"""Contains tools for finding atoms that are near to other atoms."""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+class AtomIndex:
+    """A KD-tree of every atom in a model, built once from the model's atom
+    coordinates, which can then be asked for the atoms near many atoms in a
+    single query."""
+
+    def __init__(self, model):
+        self.atoms = list(model.atoms())
+        self.tree = cKDTree(
+         np.array([atom.location for atom in self.atoms]).reshape(-1, 3)
+        )
+
+
+    def nearby_atoms(self, atoms, cutoff):
+        """Takes a list of atoms in the model, and returns a list of the sets
+        of other atoms within the cutoff distance of each of them.
+
+        As with atomium's own nearby_atoms, an atom with no chain has no
+        model and so is not near anything."""
+
+        if not atoms: return []
+        locations = np.array([atom.location for atom in atoms])
+        neighbours = self.tree.query_ball_point(locations, cutoff)
+        return [{self.atoms[i] for i in indices if self.atoms[i] is not atom}
+         if atom.model else set() for atom, indices in zip(atoms, neighbours)]
@@ -0,0 +1,69 @@
+"""Contains functions for working out the statistics shown on the homepage.
+They are saved to the database whenever it is built or clustered, so that the
+API doesn't have to count every site and residue on every visit. How many rows
+each table has is saved with them, for estimating how much work queries are."""
+
+from collections import Counter
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+
+RESOLUTIONS = [
+ ("<1.5Å", None, 1.5), ("1.5-2.0Å", 1.5, 2.0), ("2.0-2.5Å", 2.0, 2.5),
+ ("2.5-3.0Å", 2.5, 3.0), ("3.0Å+", 3.0, None)
+]
+
+def get_resolution_label(resolution):
+    """Gets the label of the range of resolutions a resolution is in."""
+
+    if resolution is None: return "NONE"
+    for label, lower, upper in RESOLUTIONS:
+        if (lower is None or resolution >= lower)\
+         and (upper is None or resolution < upper):
+            return label
+
+
+def get_stats():
+    """Works out every statistic shown on the homepage, and returns them as a
+    dict of statistic names to lists of (label, count) tuples, in the order
+    they are shown in. The rows statistic has each model's row count."""
+
+    from core.models import Residue, ZincSite, Group
+    sites = ZincSite.objects.order_by("id")
+    resolutions = Counter(map(get_resolution_label, sites.values_list(
+     "pdb__resolution", flat=True
+    )))
+    return {
+     "residues": Counter(Residue.objects.filter(
+      site__representative=True, primary=True
+     ).order_by("residue_number", "id").values_list("name", flat=True)).most_common(),
+     "techniques": Counter(str(technique).upper() for technique in
+      sites.values_list("pdb__technique", flat=True)).most_common(),
+     "species": Counter(str(organism).upper() for organism in
+      sites.values_list("pdb__organism", flat=True)).most_common(),
+     "classifications": Counter(str(classification).upper() for classification in
+      sites.values_list("pdb__classification", flat=True)).most_common(),
+     "families": Counter(family.upper() for family in sites.filter(
+      representative=True
+     ).values_list("family", flat=True)).most_common(),
+     "resolutions": [(label, resolutions[label]) for label in
+      [r[0] for r in RESOLUTIONS] + ["NONE"]],
+     "group_families": Counter(Group.objects.filter(
+      identity=settings.SEQUENCE_IDENTITIES[0]
+     ).order_by("id").values_list("family", flat=True)).most_common(),
+     "rows": [(Model.__name__, Model.objects.count())
+      for Model in apps.get_app_config("core").get_models()]
+    }
+
+
+def save_stats():
+    """Works out every statistic shown on the homepage and replaces the saved
+    ones with them."""
+
+    from core.models import StatsCount
+    with transaction.atomic():
+        StatsCount.objects.all().delete()
+        StatsCount.objects.bulk_create([StatsCount(
+         statistic=statistic, rank=rank, label=label, count=count
+        ) for statistic, counts in get_stats().items()
+         for rank, (label, count) in enumerate(counts)])
@@ -6,10 +6,14 @@ import subprocess
 import json
 from datetime import datetime
 import atomium
-from sites import remove_duplicate_atoms, get_atom_liganding_atoms
+from sites import remove_duplicate_atoms, get_liganding_atoms
 from sites import remove_salt_metals, merge_metal_groups, get_site_residues
-from sites import get_site_chains
+from sites import get_site_chains, get_site_stabilisers
 from chains import get_all_chains, get_all_residues, get_chain_sequence
+from cache import fetch_structure, get_cached_codes, get_cached_revisions
+from cache import get_pdb_revisions
+from context import StructureContext
+from descriptions import describe_pdb, describe_metal, describe_site
 
 def setup_django():
     """Sets up the django environment so that it can be used in a script."""
@@ -62,23 +66,36 @@ def get_zinc_pdb_codes():
 
 
 def get_best_model(pdb):
-    """Works out which assembly in a PDB has the lowest energy and returns that
-    model."""
+    """Works out which assembly in a PDB has the lowest energy, out of those
+    that contain metals, and returns that model. Whether an assembly contains
+    metals is worked out from the molecules it is built from, so that only the
+    chosen assembly ever has to be generated."""
 
     assemblies = sorted(pdb.assemblies, key=lambda a: math.inf
      if a["delta_energy"] is None else a["delta_energy"])
     if assemblies:
-        model = pdb.generate_assembly(assemblies[0]["id"])
-        metals = model.atoms(is_metal=True)
-        while not metals:
-            assemblies.pop(0)
-            model = pdb.generate_assembly(assemblies[0]["id"])
-            metals = model.atoms(is_metal=True)
-        return model, assemblies[0]["id"]
+        metal_molecules = get_metal_molecule_ids(pdb.model)
+        for assembly in assemblies:
+            for transformation in assembly["transformations"]:
+                if metal_molecules.intersection(transformation["chains"]):
+                    model = pdb.generate_assembly(assembly["id"])
+                    return model, assembly["id"]
+        raise ValueError(f"No assembly of {pdb.code} contains metals")
     else:
         return pdb.model, None
 
 
+def get_metal_molecule_ids(model):
+    """Gets the internal IDs of the chains and ligands in a model which contain
+    metal atoms - these are the IDs that assembly instructions refer to."""
+
+    ids = set()
+    for atom in model.atoms(is_metal=True):
+        het = atom.het
+        ids.add((het.chain if isinstance(het, atomium.Residue) else het)._internal_id)
+    return ids
+
+
 def model_is_skeleton(model):
     """Checks to see if a model contains of nothing but alpha carbons."""
 
@@ -90,13 +107,13 @@ def model_is_skeleton(model):
     return True
 
 
-def zincs_outside_model(model, pdb):
-    """Gets all zinc atoms that are not in some assembly but are in the raw PDB
-    model."""
+def zincs_outside_model(context):
+    """Gets all zinc atoms that are not in the model of some structure context
+    but are in the raw PDB model."""
 
-    au_zincs = pdb.model.atoms(element="ZN")
-    assembly_zinc_ids = [atom.id for atom in model.atoms(element="ZN")]
-    return [z for z in au_zincs if z.id not in assembly_zinc_ids]
+    if context.model is context.pdb.model: return []
+    au_zincs = context.pdb.model.atoms(element="ZN")
+    return [z for z in au_zincs if z.id not in context.zinc_ids]
 
 
 def is_cd_hit_installed():
@@ -0,0 +1,173 @@
+"""Contains the estimation of how much work a GraphQL query is, so that queries
+which would fetch too many records, or nest them too deeply, can be rejected
+before they are run."""
+
+import math
+from functools import partial
+from django.conf import settings
+from graphene.relay import Connection
+from graphql import GraphQLError
+from graphql.backend.core import GraphQLCoreBackend, GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql.language import ast
+from graphql.type import GraphQLList, GraphQLNonNull, get_named_type
+from graphql.validation import validate
+from .models import StatsCount
+from .schema import get_selected_fields, get_page_size
+
+class QueryCostEstimator:
+    """Works out how many records a GraphQL query will fetch, and how deeply
+    they are nested, without running it. Each connection is assumed to return
+    a full page, unless the tables' row counts say there are fewer records
+    than that on average for each record it is nested in, and each list of
+    related records is assumed to have that average number in it."""
+
+    def __init__(self, document, variables=None):
+        self.fragments = {definition.name.value: definition
+         for definition in document.definitions
+          if isinstance(definition, ast.FragmentDefinition)}
+        self.variables = variables or {}
+        self.rows = dict(StatsCount.objects.filter(
+         statistic="rows"
+        ).values_list("label", "count"))
+
+
+    def get_rows(self, Model):
+        """Gets how many rows a model's table has, as counted when the database
+        was last built, or counted now if it wasn't."""
+
+        if Model.__name__ not in self.rows:
+            self.rows[Model.__name__] = Model.objects.count()
+        return self.rows[Model.__name__]
+
+
+    def get_average(self, Model, parent):
+        """Estimates how many records of a model there are for each record of
+        another model, or in total if there is no other model."""
+
+        rows = self.get_rows(Model)
+        if parent: rows /= max(self.get_rows(parent), 1)
+        return max(math.ceil(rows), 1)
+
+
+    def get_arguments(self, field):
+        """Gets the values of the arguments a field was asked for with,
+        looking up any variables."""
+
+        args = {}
+        for argument in field.arguments:
+            if isinstance(argument.value, ast.Variable):
+                args[argument.name.value] = self.variables.get(
+                 argument.value.name.value
+                )
+            elif isinstance(argument.value, ast.IntValue):
+                args[argument.name.value] = int(argument.value.value)
+        return args
+
+
+    def get_cost(self, node, parent_type, parent_model=None, records=1, depth=0):
+        """Gets how many records the fields in a query node's selection set
+        will fetch, and how many records deep the query gets, given the type
+        they are selected on, the model of the records it represents, how many
+        of those records there are, and how deep they are."""
+
+        cost, max_depth = 0, depth
+        for field in get_selected_fields([node], self):
+            if field.name.value.startswith("__"): continue
+            field_type = parent_type.fields[field.name.value].type
+            named_type = get_named_type(field_type)
+            graphene_type = getattr(named_type, "graphene_type", None)
+            if graphene_type is None: continue
+            if issubclass(graphene_type, Connection):
+                Model = getattr(graphene_type._meta.node._meta, "model", None)
+                count = get_page_size(self.get_arguments(field))
+                if Model: count = min(count, self.get_average(Model, parent_model))
+                edges = [f for f in get_selected_fields([field], self)
+                 if f.name.value == "edges"]
+                nodes = [f for f in get_selected_fields(edges, self)
+                 if f.name.value == "node"]
+                node_type = named_type.fields["edges"].type
+                node_type = get_named_type(node_type).fields["node"].type
+                children = [(node, get_named_type(node_type)) for node in nodes]
+            else:
+                Model = getattr(graphene_type._meta, "model", None)
+                if isinstance(field_type, GraphQLNonNull):
+                    field_type = field_type.of_type
+                count = self.get_average(Model, parent_model)\
+                 if Model and isinstance(field_type, GraphQLList) else 1
+                children = [(field, named_type)]
+            level = depth + 1 if Model or issubclass(graphene_type, Connection)\
+             else depth
+            if level > depth: cost += records * count
+            for child, child_type in children:
+                if not hasattr(child_type, "fields"): continue
+                child_cost, child_depth = self.get_cost(
+                 child, child_type, Model, records * count, level
+                )
+                cost += child_cost
+                max_depth = max(max_depth, child_depth)
+            max_depth = max(max_depth, level)
+        return cost, max_depth
+
+
+
+def get_query_cost_errors(schema, document, variables=None, operation_name=None):
+    """Checks that a query is within the page size, depth and cost limits, and
+    returns errors for any it isn't within."""
+
+    operations = [definition for definition in document.definitions
+     if isinstance(definition, ast.OperationDefinition) and (
+      operation_name is None or (
+       definition.name and definition.name.value == operation_name
+      ))]
+    if not operations: return []
+    root = schema.get_mutation_type() if operations[0].operation == "mutation"\
+     else schema.get_query_type()
+    try:
+        cost, depth = QueryCostEstimator(document, variables).get_cost(
+         operations[0], root
+        )
+    except ValueError as e: return [GraphQLError(str(e))]
+    errors = []
+    if depth > settings.MAX_QUERY_DEPTH:
+        errors.append(GraphQLError(
+         f"Query nests records {depth} deep, but they can only be nested "
+         f"{settings.MAX_QUERY_DEPTH} deep"
+        ))
+    if cost > settings.MAX_QUERY_COST:
+        errors.append(GraphQLError(
+         f"Query would fetch an estimated {cost} records, but it can only "
+         f"fetch {settings.MAX_QUERY_COST}"
+        ))
+    return errors
+
+
+def execute_within_limits(schema, document, *args, **kwargs):
+    """Validates a query, and then checks it against the page size, depth and
+    cost limits, before running it."""
+
+    kwargs.pop("validate", None)
+    errors = validate(schema, document) or get_query_cost_errors(
+     schema, document, kwargs.get("variable_values"),
+     kwargs.get("operation_name")
+    )
+    if errors: return ExecutionResult(errors=errors, invalid=True)
+    return execute(schema, document, *args, **kwargs)
+
+
+
+class CostLimitedBackend(GraphQLCoreBackend):
+    """A GraphQL backend which rejects queries over the limits on how much
+    work they can be, without running them."""
+
+    def document_from_string(self, schema, document_string):
+        document = GraphQLCoreBackend.document_from_string(
+         self, schema, document_string
+        )
+        return GraphQLDocument(
+         schema=schema, document_string=document.document_string,
+         document_ast=document.document_ast, execute=partial(
+          execute_within_limits, schema, document.document_ast,
+          **self.execute_params
+         )
+        )
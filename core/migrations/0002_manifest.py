@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-18 07:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManifestEntry',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('revision', models.CharField(max_length=32)),
+            ],
+            options={
+                'db_table': 'manifest',
+            },
+        ),
+    ]
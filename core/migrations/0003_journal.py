@@ -0,0 +1,27 @@
+# Generated by Django 2.2.13 on 2026-10-18 07:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_manifest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JournalEntry',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('pending', 'pending'), ('done', 'done'), ('failed', 'failed')], max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('exception', models.CharField(blank=True, max_length=256)),
+                ('traceback', models.TextField(blank=True)),
+            ],
+            options={
+                'db_table': 'journal',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 07:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_journal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zincsite',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=1024),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.13 on 2026-10-18 07:41
+
+import core.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaincluster',
+            name='identity',
+            field=models.FloatField(db_index=True, default=core.models.get_default_identity),
+        ),
+        migrations.AddField(
+            model_name='chaincluster',
+            name='parent',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='children', to='core.ChainCluster'),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='identity',
+            field=models.FloatField(db_index=True, default=core.models.get_default_identity),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='parent',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='children', to='core.Group'),
+        ),
+    ]
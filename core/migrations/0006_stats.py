@@ -0,0 +1,85 @@
+# Generated by Django 2.2.13 on 2026-10-18 08:08
+
+from collections import Counter
+from django.db import migrations, models
+
+RESOLUTIONS = [
+ ("<1.5Å", None, 1.5), ("1.5-2.0Å", 1.5, 2.0), ("2.0-2.5Å", 2.0, 2.5),
+ ("2.5-3.0Å", 2.5, 3.0), ("3.0Å+", 3.0, None)
+]
+
+def get_resolution_label(resolution):
+    if resolution is None: return "NONE"
+    for label, lower, upper in RESOLUTIONS:
+        if (lower is None or resolution >= lower)\
+         and (upper is None or resolution < upper):
+            return label
+
+
+def fill_stats(apps, schema_editor):
+    """Works out the homepage statistics for the records already in the
+    database, as build/stats.py did when this migration was written. It is a
+    copy rather than an import, so that it doesn't change if that does."""
+
+    Residue, ZincSite, Group, StatsCount = [apps.get_model("core", name)
+     for name in ("Residue", "ZincSite", "Group", "StatsCount")]
+    sites = ZincSite.objects.order_by("id")
+    resolutions = Counter(map(get_resolution_label, sites.values_list(
+     "pdb__resolution", flat=True
+    )))
+    # Groups are first made at the highest sequence identity
+    identities = sorted(set(
+     Group.objects.values_list("identity", flat=True)
+    ), reverse=True)
+    stats = {
+     "residues": Counter(Residue.objects.filter(
+      site__representative=True, primary=True
+     ).order_by("residue_number", "id").values_list("name", flat=True)).most_common(),
+     "techniques": Counter(str(technique).upper() for technique in
+      sites.values_list("pdb__technique", flat=True)).most_common(),
+     "species": Counter(str(organism).upper() for organism in
+      sites.values_list("pdb__organism", flat=True)).most_common(),
+     "classifications": Counter(str(classification).upper() for classification in
+      sites.values_list("pdb__classification", flat=True)).most_common(),
+     "families": Counter(family.upper() for family in sites.filter(
+      representative=True
+     ).values_list("family", flat=True)).most_common(),
+     "resolutions": [(label, resolutions[label]) for label in
+      [r[0] for r in RESOLUTIONS] + ["NONE"]],
+     "group_families": Counter(Group.objects.filter(
+      identity__in=identities[:1]
+     ).order_by("id").values_list("family", flat=True)).most_common(),
+     "rows": [(Model.__name__, Model.objects.count())
+      for Model in apps.get_app_config("core").get_models()]
+    }
+    StatsCount.objects.bulk_create([StatsCount(
+     statistic=statistic, rank=rank, label=label, count=count
+    ) for statistic, counts in stats.items()
+     for rank, (label, count) in enumerate(counts)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_hierarchy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('statistic', models.CharField(max_length=32)),
+                ('rank', models.IntegerField()),
+                ('label', models.CharField(max_length=1024)),
+                ('count', models.IntegerField()),
+            ],
+            options={
+                'db_table': 'stats',
+                'unique_together': {('statistic', 'rank')},
+            },
+        ),
+        migrations.RunPython(
+            fill_stats, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-18 08:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatabaseVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stamp', models.CharField(max_length=32)),
+            ],
+            options={
+                'db_table': 'database_version',
+            },
+        ),
+    ]
@@ -0,0 +1,72 @@
+import core.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+INDEXES = [
+ ("pdbs_search",
+  "id UNINDEXED, code, title, classification, technique, organism, keywords",
+  """SELECT id, id, title, classification, technique, organism, keywords
+  FROM PDBs"""),
+ ("groups_search", "id UNINDEXED, code, family, keywords, classifications",
+  "SELECT id, id, family, keywords, classifications FROM groups"),
+ ("zinc_sites_search",
+  "id UNINDEXED, code, family, residue_names, title, classification, "
+  "organism, keywords",
+  """SELECT zinc_sites.id, zinc_sites.id, family, residue_names, title, classification,
+  organism, keywords FROM zinc_sites INNER JOIN PDBs
+  ON zinc_sites.pdb_id = PDBs.id""")
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_database_version'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [
+                f"CREATE VIRTUAL TABLE {table} USING fts5({columns}, prefix='2 3')",
+                f"INSERT INTO {table} {select}"
+            ],
+            f"DROP TABLE {table}"
+        ) for table, columns, select in INDEXES
+    ] + [
+        migrations.CreateModel(
+            name='PdbSearchEntry',
+            fields=[
+                ('pdb', models.OneToOneField(db_column='id', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='core.Pdb')),
+                ('index', core.models.SearchIndexField(db_column='pdbs_search')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'pdbs_search',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='GroupSearchEntry',
+            fields=[
+                ('group', models.OneToOneField(db_column='id', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='core.Group')),
+                ('index', core.models.SearchIndexField(db_column='groups_search')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'groups_search',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ZincSiteSearchEntry',
+            fields=[
+                ('site', models.OneToOneField(db_column='id', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='core.ZincSite')),
+                ('index', core.models.SearchIndexField(db_column='zinc_sites_search')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'zinc_sites_search',
+                'managed': False,
+            },
+        ),
+    ]
@@ -1,9 +1,39 @@
 import subprocess
 import json
+import uuid
 import atomium
 from django.db import models
+from django.db.models import Q
 from django.conf import settings
 
+def get_default_identity():
+    """Gets the sequence identity at which chains are first clustered."""
+
+    return settings.SEQUENCE_IDENTITIES[0]
+
+
+def get_nesting_paths(field):
+    """Chain clusters and groups are nested within those made at lower sequence
+    identities. Given the name of a field pointing to the most specific level,
+    this gets the lookups which lead from it to each level."""
+
+    return [
+     field + "__parent" * depth
+     for depth in range(len(settings.SEQUENCE_IDENTITIES))
+    ]
+
+
+def get_nesting_filter(field, record):
+    """Gets a Q object which selects everything inside some chain cluster or
+    group, at whatever level it is, given the name of a field pointing to the
+    most specific level."""
+
+    q = Q()
+    for path in get_nesting_paths(field):
+        q |= Q(**{path: record})
+    return q
+
+
 class Pdb(models.Model):
     """Represents a PDB structure file."""
 
@@ -24,9 +54,79 @@ class Pdb(models.Model):
     skeleton = models.BooleanField()
 
 
+class ManifestEntry(models.Model):
+    """A record of which revision of a PDB entry the database was built from."""
+
+    class Meta:
+        db_table = "manifest"
+
+    id = models.CharField(primary_key=True, max_length=32)
+    revision = models.CharField(max_length=32)
+
+
+class JournalEntry(models.Model):
+    """A record of the last attempt to process a PDB entry during a build."""
+
+    class Meta:
+        db_table = "journal"
+
+    id = models.CharField(primary_key=True, max_length=32)
+    state = models.CharField(max_length=16, choices=(
+     ("pending", "pending"), ("done", "done"), ("failed", "failed")
+    ))
+    attempts = models.IntegerField(default=0)
+    duration = models.FloatField(null=True, blank=True)
+    exception = models.CharField(max_length=256, blank=True)
+    traceback = models.TextField(blank=True)
+
+
+
+class DatabaseVersion(models.Model):
+    """A stamp which changes whenever the database is built or clustered, so
+    that anything worked out from the data before then can be told apart."""
+
+    class Meta:
+        db_table = "database_version"
+
+    stamp = models.CharField(max_length=32)
+
+    @staticmethod
+    def get_stamp():
+        """Gets the current stamp, or None if there has never been one."""
+
+        return DatabaseVersion.objects.values_list("stamp", flat=True).first()
+
+
+    @staticmethod
+    def bump():
+        """Replaces the current stamp with a new one."""
+
+        DatabaseVersion.objects.update_or_create(
+         id=1, defaults={"stamp": uuid.uuid4().hex}
+        )
+
+
+
+class StatsCount(models.Model):
+    """One count in a statistic shown on the homepage, such as how many zinc
+    sites were found with some technique. These are worked out whenever the
+    database is built or clustered, and rank gives their order in the
+    statistic, most common first."""
+
+    class Meta:
+        db_table = "stats"
+        unique_together = [["statistic", "rank"]]
+
+    statistic = models.CharField(max_length=32)
+    rank = models.IntegerField()
+    label = models.CharField(max_length=1024)
+    count = models.IntegerField()
+
+
 
 class Group(models.Model):
-    """A collection of equivalent zinc sites."""
+    """A collection of equivalent zinc sites. Groups made at lower sequence
+    identities contain those made at higher ones."""
 
     class Meta:
         db_table = "groups"
@@ -35,6 +135,15 @@ class Group(models.Model):
     family = models.CharField(max_length=128)
     keywords = models.CharField(max_length=1024)
     classifications = models.CharField(max_length=1024)
+    identity = models.FloatField(default=get_default_identity, db_index=True)
+    parent = models.ForeignKey(
+     "self", on_delete=models.SET_NULL, null=True, default=None,
+     related_name="children"
+    )
+
+    @property
+    def all_sites(self):
+        return ZincSite.objects.filter(get_nesting_filter("group", self))
 
 
 
@@ -48,6 +157,7 @@ class ZincSite(models.Model):
     family = models.CharField(max_length=128)
     residue_names = models.CharField(max_length=512)
     representative = models.BooleanField(default=False)
+    fingerprint = models.CharField(max_length=1024, blank=True, db_index=True)
     pdb = models.ForeignKey(Pdb, on_delete=models.CASCADE)
     group = models.ForeignKey(Group, on_delete=models.SET_NULL, null=True, default=None)
 
@@ -81,12 +191,22 @@ class Metal(models.Model):
 
 
 class ChainCluster(models.Model):
-    """A collection of chains with similar sequence."""
+    """A collection of chains with similar sequence. Clusters made at lower
+    sequence identities contain those made at higher ones."""
 
     class Meta:
         db_table = "chain_clusters"
     
     id = models.CharField(primary_key=True, max_length=128)
+    identity = models.FloatField(default=get_default_identity, db_index=True)
+    parent = models.ForeignKey(
+     "self", on_delete=models.SET_NULL, null=True, default=None,
+     related_name="children"
+    )
+
+    @property
+    def all_chains(self):
+        return Chain.objects.filter(get_nesting_filter("cluster", self))
 
 
 
@@ -198,4 +318,71 @@ class StabilisingBond(models.Model):
         db_table = "stabilising_bonds"
 
     primary_atom = models.ForeignKey(Atom, on_delete=models.CASCADE, related_name="primary_stabilisers")
-    secondary_atom = models.ForeignKey(Atom, on_delete=models.CASCADE, related_name="secondary_stabilisers")
\ No newline at end of file
+    secondary_atom = models.ForeignKey(Atom, on_delete=models.CASCADE, related_name="secondary_stabilisers")
+
+
+class SearchIndexField(models.TextField):
+    """The hidden column of an FTS5 table which has the table's name, and which
+    full-text queries are matched against."""
+
+
+
+@SearchIndexField.register_lookup
+class Match(models.Lookup):
+    """Matches the rows of an FTS5 table against a full-text query."""
+
+    lookup_name = "match"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} MATCH {rhs}", lhs_params + rhs_params
+
+
+
+class PdbSearchEntry(models.Model):
+    """A PDB's entry in the full-text search index of PDBs. The index is an
+    FTS5 table, which Django doesn't create or flush."""
+
+    class Meta:
+        db_table = "pdbs_search"
+        managed = False
+
+    pdb = models.OneToOneField(
+     Pdb, primary_key=True, db_column="id", db_constraint=False,
+     on_delete=models.DO_NOTHING, related_name="search_entry"
+    )
+    index = SearchIndexField(db_column="pdbs_search")
+    rank = models.FloatField()
+
+
+
+class GroupSearchEntry(models.Model):
+    """A group's entry in the full-text search index of groups."""
+
+    class Meta:
+        db_table = "groups_search"
+        managed = False
+
+    group = models.OneToOneField(
+     Group, primary_key=True, db_column="id", db_constraint=False,
+     on_delete=models.DO_NOTHING, related_name="search_entry"
+    )
+    index = SearchIndexField(db_column="groups_search")
+    rank = models.FloatField()
+
+
+
+class ZincSiteSearchEntry(models.Model):
+    """A zinc site's entry in the full-text search index of zinc sites."""
+
+    class Meta:
+        db_table = "zinc_sites_search"
+        managed = False
+
+    site = models.OneToOneField(
+     ZincSite, primary_key=True, db_column="id", db_constraint=False,
+     on_delete=models.DO_NOTHING, related_name="search_entry"
+    )
+    index = SearchIndexField(db_column="zinc_sites_search")
+    rank = models.FloatField()
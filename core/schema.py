@@ -1,11 +1,20 @@
 import re
-from collections import Counter
+import json
+import base64
 import graphene
 from graphene_django.types import DjangoObjectType
-from graphene.relay import Connection, ConnectionField
+from graphene.relay import Connection, ConnectionField, PageInfo
+from graphql.language import ast
+from graphql.type import get_named_type
+from promise import Promise
+from promise.dataloader import DataLoader
 from django.conf import settings
-from django.db.models import F, Q, Count
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q, Count, Min, Sum, Value, Prefetch, QuerySet
+from django.db.models.functions import Least
 from .models import *
+from .search import search_records
 
 def camel_case(string, suffix=None):
     """Converts a string in snake_case to a string in camelCase. If a suffix is
@@ -21,6 +30,16 @@ def camel_case(string, suffix=None):
     return string
 
 
+def snake_case(string):
+    """Converts a string in camelCase to a string in snake_case.
+
+    depositionDate becomes deposition_date, depositionDate__gt becomes
+    deposition_date__gt."""
+
+    string = re.sub("(.)([A-Z][a-z]+)", r"\1_\2", string)
+    return re.sub("([a-z0-9])([A-Z])", r"\1_\2", string).lower()
+
+
 def process_kwargs(kwargs):
     """Takes some arguments sent in from a GraphQL query, removes those which
     can't be passed to a model filter, and converts any camelCase keys to
@@ -28,13 +47,377 @@ def process_kwargs(kwargs):
 
     processed = {}
     for key, value in kwargs.items():
-        if key not in ["sort", "skip", "first", "last", "term"]:
-            key = re.sub("(.)([A-Z][a-z]+)", r"\1_\2", key)
-            key = re.sub("([a-z0-9])([A-Z])", r"\1_\2", key).lower()
-            processed[key] = value
+        if key not in ["sort", "skip", "first", "last", "after", "before", "term"]:
+            processed[snake_case(key)] = value
     return processed
 
 
+def filter_identity(records, kwargs):
+    """Chain clusters and groups are stored at several sequence identities.
+    Unless some identity is asked for, only those at the first are used."""
+
+    if any(key.startswith("identity") for key in kwargs): return records
+    return records.filter(identity=settings.SEQUENCE_IDENTITIES[0])
+
+
+def get_site_count(kwargs):
+    """Gets an annotation which counts the sites in groups. Groups at lower
+    sequence identities contain their sites through their child groups, so if
+    it isn't known which identity the groups are at, every level is counted."""
+
+    identities = settings.SEQUENCE_IDENTITIES
+    if not any(key.startswith("identity") for key in kwargs):
+        depths = [0]
+    elif kwargs.get("identity") in identities:
+        depths = [identities.index(kwargs["identity"])]
+    else:
+        depths = range(len(identities))
+    counts = [Count("children__" * d + "zincsite", distinct=True) for d in depths]
+    return sum(counts[1:], counts[0])
+
+
+def get_selected_fields(nodes, info):
+    """Gets the fields asked for in the selection sets of some GraphQL query
+    nodes, including those asked for in fragments."""
+
+    fields = []
+    for node in nodes:
+        for selection in node.selection_set.selections if node.selection_set else []:
+            if isinstance(selection, ast.Field):
+                fields.append(selection)
+            elif isinstance(selection, ast.FragmentSpread):
+                fields += get_selected_fields(
+                 [info.fragments[selection.name.value]], info
+                )
+            else:
+                fields += get_selected_fields([selection], info)
+    return fields
+
+
+def get_record_fields(info):
+    """Gets the fields asked for on the records a GraphQL field resolves to.
+    For connection fields, these are the fields asked for on each node."""
+
+    fields = get_selected_fields(info.field_asts, info)
+    if issubclass(get_named_type(info.return_type).graphene_type, Connection):
+        edges = [f for f in fields if f.name.value == "edges"]
+        nodes = [f for f in get_selected_fields(edges, info) if f.name.value == "node"]
+        fields = get_selected_fields(nodes, info)
+    return fields
+
+
+def plan_query(records, fields, info, columns=()):
+    """Takes a queryset and the GraphQL fields asked for on its records, and
+    makes it load only the columns asked for. Forward relations asked for are
+    fetched in the same query with select_related, and reverse relations with
+    one more query each, using prefetch_related with querysets planned in the
+    same way. Any other columns which are needed can also be given.
+
+    Once fewer columns are loaded the database may read them from an index,
+    in index order, so records are ordered by primary key after any ordering
+    they already have."""
+
+    columns, related, prefetches = set(columns), [], []
+    add_to_plan(records.model, fields, info, "", columns, related, prefetches)
+    if related: records = records.select_related(*related)
+    if prefetches: records = records.prefetch_related(*prefetches)
+    if not records.query.order_by:
+        records = records.order_by(*records.model._meta.ordering, "pk")
+    return records.only(*columns)
+
+
+def add_to_plan(Model, fields, info, prefix, columns, related, prefetches):
+    """Works out the columns, forward relations and reverse relations which a
+    query needs to load for some GraphQL fields asked for on a model, which is
+    reached from the query's model by a prefix of lookups."""
+
+    reverse = {rel.get_accessor_name(): rel for rel in Model._meta.related_objects}
+    columns.add(prefix + Model._meta.pk.name)
+    for field in fields:
+        name = snake_case(field.name.value)
+        if name in reverse:
+            rel = reverse[name]
+            prefetches.append(Prefetch(prefix + name, queryset=plan_query(
+             rel.related_model.objects.all(),
+             get_selected_fields([field], info), info, columns=[rel.field.name]
+            )))
+            continue
+        try:
+            model_field = Model._meta.get_field(name)
+        except FieldDoesNotExist: continue
+        if model_field.concrete:
+            columns.add(prefix + name)
+            if model_field.is_relation:
+                related.append(prefix + name)
+                add_to_plan(
+                 model_field.related_model, get_selected_fields([field], info),
+                 info, prefix + name + "__", columns, related, prefetches
+                )
+
+
+
+def get_planned_records(Model, info):
+    """Gets a queryset of all of a model's records, planned for the GraphQL
+    field being resolved."""
+
+    return plan_query(Model.objects.all(), get_record_fields(info), info)
+
+
+
+class ChildLoader(DataLoader):
+    """Loads the child records of many parent records at once, given the
+    parents' primary keys, so that a whole level of a GraphQL query needs one
+    database query rather than one per parent. A child belongs to a parent if
+    any of a list of lookups leads from it to the parent, and the children are
+    taken from a queryset, and filtered, searched and sorted according to the
+    GraphQL arguments given. Each parent's children are given their sort keys,
+    so that they can be paged through."""
+
+    def __init__(self, records, paths, kwargs):
+        DataLoader.__init__(self, max_batch_size=250)
+        self.records, self.paths, self.kwargs = records, paths, kwargs
+
+
+    def batch_load_fn(self, keys):
+        q = Q()
+        for path in self.paths: q |= Q(**{path + "__in": keys})
+        records = self.records.filter(q).filter(**process_kwargs(self.kwargs))
+        if "term" in self.kwargs: records = search_records(records, self.kwargs["term"])
+        if "sort" in self.kwargs: records = records.order_by(self.kwargs["sort"])
+        ordering = get_ordering(records)
+        records = add_sort_keys(records.order_by(*ordering), ordering).annotate(**{
+         f"parent_{n}": F(path) for n, path in enumerate(self.paths)
+        })
+        children = {key: [] for key in keys}
+        for record in records:
+            for parent in set(getattr(record, f"parent_{n}") for n in range(len(self.paths))):
+                if parent in children: children[parent].append(record)
+        return Promise.resolve([Children(children[key], ordering) for key in keys])
+
+
+
+class Children(list):
+    """A list of child records, which knows what they are ordered by."""
+
+    def __init__(self, records, ordering):
+        list.__init__(self, records)
+        self.ordering = ordering
+
+
+
+def load_children(info, parent, Model, paths, kwargs):
+    """Gets a promise of the records of a model which belong to a parent record.
+    The loaders which fetch them are kept on the request, one for each place
+    in the query they are asked for, so that the children of every parent at
+    one level of a query are fetched together, loading only what is asked for
+    on them."""
+
+    loaders = getattr(info.context, "loaders", None)
+    if loaders is None:
+        loaders = {}
+        try:
+            info.context.loaders = loaders
+        except AttributeError: pass
+    key = (tuple(info.field_asts), Model, tuple(paths), tuple(sorted(kwargs.items())))
+    if key not in loaders:
+        loaders[key] = ChildLoader(get_planned_records(Model, info), paths, kwargs)
+    return loaders[key].load(parent.pk)
+
+
+def load_related(info, manager, kwargs):
+    """Gets a promise of the records in a related manager, in the same way."""
+
+    return load_children(
+     info, manager.instance, manager.model, [manager.field.name], kwargs
+    )
+
+
+def get_only(Model):
+    """Gets a function which takes a list of records and returns the only one,
+    raising the model's usual exception if there isn't one."""
+
+    def only(records):
+        if not records: raise Model.DoesNotExist(
+         f"{Model._meta.object_name} matching query does not exist."
+        )
+        return records[0]
+    return only
+
+
+def get_ordering(records):
+    """Gets the fields a queryset is ordered by, ending with its primary key so
+    that no two records have the same sort key."""
+
+    ordering = list(records.query.order_by or records.model._meta.ordering)
+    pk = records.model._meta.pk.name
+    if not set(ordering) & {"pk", "-pk", pk, "-" + pk}: ordering.append("pk")
+    return ordering
+
+
+def add_sort_keys(records, ordering):
+    """Annotates the records of a queryset with the values of the fields they
+    are ordered by."""
+
+    return records.annotate(**{
+     f"sort_key_{n}": F(field.lstrip("-")) for n, field in enumerate(ordering)
+    })
+
+
+def get_sort_key(record, ordering):
+    """Gets the sort key of an annotated record, as it would be read back from
+    a cursor - so dates become strings, for example."""
+
+    return json.loads(json.dumps([
+     getattr(record, f"sort_key_{n}") for n in range(len(ordering))
+    ], cls=DjangoJSONEncoder))
+
+
+def encode_cursor(key):
+    """Turns a sort key into an opaque cursor string."""
+
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor, ordering):
+    """Turns a cursor string back into a sort key, checking that it is a sort
+    key for the ordering given."""
+
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError: key = None
+    if not isinstance(key, list) or len(key) != len(ordering):
+        raise ValueError(f"{cursor} is not a valid cursor")
+    return key
+
+
+def get_page_size(args):
+    """Gets how many records a connection can return at most, given the
+    arguments it was asked for. Connections asked for neither first nor last
+    get the default page size, and neither can be more than the maximum."""
+
+    for arg in ("first", "last"):
+        if args.get(arg) is not None and args[arg] > settings.MAX_PAGE_SIZE:
+            raise ValueError(
+             f"{arg} cannot be more than {settings.MAX_PAGE_SIZE}"
+            )
+    sizes = [args[arg] for arg in ("first", "last") if args.get(arg) is not None]
+    return min(sizes) if sizes else settings.DEFAULT_PAGE_SIZE
+
+
+def get_keyset_filter(ordering, key, after=True):
+    """Makes a filter for the records which come after the record with a given
+    sort key in some ordering, or before it. Nulls come before everything else,
+    as they do in SQLite."""
+
+    q, equal = Q(pk__in=[]), Q()
+    for field, value in zip(ordering, key):
+        field, larger = field.lstrip("-"), field.startswith("-") != after
+        if value is None:
+            beyond = Q(**{field + "__isnull": False}) if larger else None
+            same = Q(**{field + "__isnull": True})
+        else:
+            beyond = Q(**{field + "__gt": value}) if larger else\
+             Q(**{field + "__lt": value}) | Q(**{field + "__isnull": True})
+            same = Q(**{field: value})
+        if beyond is not None: q |= equal & beyond
+        equal &= same
+    return q
+
+
+def compare_sort_keys(key1, key2, ordering):
+    """Compares two sort keys in some ordering, returning -1 if the first comes
+    first, 1 if it comes second, and 0 if they are the same."""
+
+    for field, value1, value2 in zip(ordering, key1, key2):
+        if value1 != value2:
+            smaller = value2 is not None and (value1 is None or value1 < value2)
+            return -1 if smaller != field.startswith("-") else 1
+    return 0
+
+
+def page_records(records, ordering, args):
+    """Takes the records of a connection, as an ordered queryset or as a list
+    of records annotated with sort keys, and pages through them using the
+    connection arguments. The records after any cursor and skip are returned,
+    along with the page of them and whether there are records on either side
+    of it. Querysets are filtered by their sort keys rather than offset, so
+    that later pages cost the same as the first, and only the page itself is
+    annotated, so that the records can still be counted with a plain COUNT."""
+
+    for arg, after in (("after", True), ("before", False)):
+        if args.get(arg):
+            key = decode_cursor(args[arg], ordering)
+            if isinstance(records, QuerySet):
+                records = records.filter(get_keyset_filter(ordering, key, after))
+            else:
+                records = [r for r in records if compare_sort_keys(
+                 get_sort_key(r, ordering), key, ordering
+                ) == (1 if after else -1)]
+    first, last = args.get("first"), args.get("last")
+    keyed = add_sort_keys(records, ordering)\
+     if isinstance(records, QuerySet) else records
+    if args.get("skip"):
+        records, keyed = records[args["skip"]:], keyed[args["skip"]:]
+    if first is None and last is None: records = keyed
+    has_previous, has_next = False, False
+    if first is None and last is not None and isinstance(keyed, QuerySet)\
+     and not args.get("skip"):
+        page = list(keyed.reverse()[:last + 1])[::-1]
+    else:
+        page = list(keyed[:first + 1] if first is not None else keyed)
+        if first is not None:
+            has_next, page = len(page) > first, page[:first]
+    if last is not None:
+        has_previous, page = len(page) > last, page[max(len(page) - last, 0):]
+    return records, page, has_previous, has_next
+
+
+def count_records(records):
+    """Counts the records in a queryset with one COUNT query, unless they have
+    already been loaded, or in a list."""
+
+    return records.count() if isinstance(records, QuerySet) else len(records)
+
+
+
+class RecordConnectionField(ConnectionField):
+    """A connection field whose records are paged through using cursors made
+    from their sort keys. The records can be a queryset or a list of child
+    records, and the connection keeps hold of them so that they are only
+    counted if they need to be. Any other list is paged through by position.
+    Connections asked for no page size get the default one."""
+
+    @classmethod
+    def resolve_connection(cls, connection_type, args, resolved):
+        if args.get("first") is None and args.get("last") is None:
+            args = {**args, "first": get_page_size(args)}
+        else: get_page_size(args)
+        if not isinstance(resolved, (QuerySet, Children)):
+            return super().resolve_connection(connection_type, args, resolved)
+        if isinstance(resolved, Children):
+            ordering = resolved.ordering
+        else:
+            ordering = get_ordering(resolved)
+            resolved = resolved.order_by(*ordering)
+        records, page, has_previous, has_next = page_records(
+         resolved, ordering, args
+        )
+        all_records = resolved if any(
+         args.get(arg) for arg in ("after", "before", "skip")
+        ) else records
+        edges = [connection_type.Edge(
+         node=record, cursor=encode_cursor(get_sort_key(record, ordering))
+        ) for record in page]
+        connection = connection_type(edges=edges, page_info=PageInfo(
+         start_cursor=edges[0].cursor if edges else None,
+         end_cursor=edges[-1].cursor if edges else None,
+         has_previous_page=has_previous, has_next_page=has_next
+        ))
+        connection.records, connection.all_records = records, all_records
+        return connection
+
+
+
 def add_field_to_args(args, field, Type, suffixes, prefix):
     """Takes a django model field, and adds it to a dictionary representing the
     arguments that can be passed to a GraphQL field. Variants with different
@@ -96,31 +479,35 @@ class CoordinateBondConnection(Connection):
         node = CoordinateBondType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasCoordinateBonds:
 
     coordinate_bond = graphene.Field(CoordinateBondType, id=graphene.Int(required=True))
-    coordinate_bonds = graphene.ConnectionField(CoordinateBondConnection, **generate_args(CoordinateBond))
+    coordinate_bonds = RecordConnectionField(CoordinateBondConnection, **generate_args(CoordinateBond))
 
     def resolve_coordinate_bond(self, info, **kwargs):
-        try:
-            return self.coordinatebond_set.get(id=kwargs["id"])
-        except AttributeError:
-            return CoordinateBond.objects.get(id=kwargs["id"])
+        if self is not None:
+            return load_related(
+             info, self.coordinatebond_set, {"id": kwargs["id"]}
+            ).then(get_only(CoordinateBond))
+        return get_planned_records(CoordinateBond, info).get(id=kwargs["id"])
     
 
     def resolve_coordinate_bonds(self, info, **kwargs):
-        try:
-            coordinate_bonds = self.coordinatebond_set.filter(**process_kwargs(kwargs))
-        except AttributeError:
-            coordinate_bonds = CoordinateBond.objects.filter(**process_kwargs(kwargs))
+        if self is not None:
+            return load_related(info, self.coordinatebond_set, kwargs)
+        coordinate_bonds = get_planned_records(CoordinateBond, info).filter(**process_kwargs(kwargs))
         if "sort" in kwargs: coordinate_bonds = coordinate_bonds.order_by(kwargs["sort"])
-        if "skip" in kwargs: coordinate_bonds = coordinate_bonds[kwargs["skip"]:]
         return coordinate_bonds
 
 
@@ -138,34 +525,36 @@ class StabilisingBondConnection(Connection):
         node = StabilisingBondType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasStabilisingBonds:
 
     stabilising_bond = graphene.Field(StabilisingBondType, id=graphene.Int(required=True))
-    stabilising_bonds = graphene.ConnectionField(StabilisingBondConnection, **generate_args(StabilisingBond))
+    stabilising_bonds = RecordConnectionField(StabilisingBondConnection, **generate_args(StabilisingBond))
 
     def resolve_stabilising_bond(self, info, **kwargs):
         try:
             return self.stabilisingbond_set.get(id=kwargs["id"])
         except AttributeError:
-            return StabilisingBond.objects.get(id=kwargs["id"])
+            return get_planned_records(StabilisingBond, info).get(id=kwargs["id"])
     
 
     def resolve_stabilising_bonds(self, info, **kwargs):
-        try:
-            stabilising_bonds = self.stabilisingbond_set.filter(**process_kwargs(kwargs))
-        except AttributeError:
-            try:
-                stabilising_bonds = self.stabilising_bonds.filter(**process_kwargs(kwargs))
-            except AttributeError:
-                stabilising_bonds = StabilisingBond.objects.filter(**process_kwargs(kwargs))
+        if self is not None:
+            paths = ["primary_atom", "secondary_atom"] if isinstance(self, Atom) \
+             else ["primary_atom__residue__site"]
+            return load_children(info, self, StabilisingBond, paths, kwargs)
+        stabilising_bonds = get_planned_records(StabilisingBond, info).filter(**process_kwargs(kwargs))
         if "sort" in kwargs: stabilising_bonds = stabilising_bonds.order_by(kwargs["sort"])
-        if "skip" in kwargs: stabilising_bonds = stabilising_bonds[kwargs["skip"]:]
         return stabilising_bonds
 
 
@@ -183,31 +572,35 @@ class AtomConnection(Connection):
         node = AtomType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasAtoms:
 
     atom = graphene.Field(AtomType, id=graphene.Int(required=True))
-    atoms = graphene.ConnectionField(AtomConnection, **generate_args(Atom))
+    atoms = RecordConnectionField(AtomConnection, **generate_args(Atom))
 
     def resolve_atom(self, info, **kwargs):
-        try:
-            return self.atom_set.get(id=kwargs["id"])
-        except AttributeError:
-            return Atom.objects.get(id=kwargs["id"])
+        if self is not None:
+            return load_related(
+             info, self.atom_set, {"id": kwargs["id"]}
+            ).then(get_only(Atom))
+        return get_planned_records(Atom, info).get(id=kwargs["id"])
     
 
     def resolve_atoms(self, info, **kwargs):
-        try:
-            atoms = self.atom_set.filter(**process_kwargs(kwargs))
-        except AttributeError:
-            atoms = Atom.objects.filter(**process_kwargs(kwargs))
+        if self is not None:
+            return load_related(info, self.atom_set, kwargs)
+        atoms = get_planned_records(Atom, info).filter(**process_kwargs(kwargs))
         if "sort" in kwargs: atoms = atoms.order_by(kwargs["sort"])
-        if "skip" in kwargs: atoms = atoms[kwargs["skip"]:]
         return atoms
 
 
@@ -225,31 +618,35 @@ class ResidueConnection(Connection):
         node = ResidueType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasResidues:
 
     residue = graphene.Field(ResidueType, id=graphene.Int(required=True))
-    residues = graphene.ConnectionField(ResidueConnection, **generate_args(Residue))
+    residues = RecordConnectionField(ResidueConnection, **generate_args(Residue))
 
     def resolve_residue(self, info, **kwargs):
-        try:
-            return self.residue_set.get(id=kwargs["id"])
-        except AttributeError:
-            return Residue.objects.get(id=kwargs["id"])
+        if self is not None:
+            return load_related(
+             info, self.residue_set, {"id": kwargs["id"]}
+            ).then(get_only(Residue))
+        return get_planned_records(Residue, info).get(id=kwargs["id"])
     
 
     def resolve_residues(self, info, **kwargs):
-        try:
-            residues = self.residue_set.filter(**process_kwargs(kwargs))
-        except AttributeError:
-            residues = Residue.objects.filter(**process_kwargs(kwargs))
+        if self is not None:
+            return load_related(info, self.residue_set, kwargs)
+        residues = get_planned_records(Residue, info).filter(**process_kwargs(kwargs))
         if "sort" in kwargs: residues = residues.order_by(kwargs["sort"])
-        if "skip" in kwargs: residues = residues[kwargs["skip"]:]
         return residues
 
 
@@ -267,31 +664,35 @@ class MetalConnection(Connection):
         node = MetalType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasMetals:
 
     metal = graphene.Field(MetalType, id=graphene.Int(required=True))
-    metals = graphene.ConnectionField(MetalConnection, **generate_args(Metal))
+    metals = RecordConnectionField(MetalConnection, **generate_args(Metal))
 
     def resolve_metal(self, info, **kwargs):
-        try:
-            return self.metal_set.get(id=kwargs["id"])
-        except AttributeError:
-            return Metal.objects.get(id=kwargs["id"])
+        if self is not None:
+            return load_related(
+             info, self.metal_set, {"id": kwargs["id"]}
+            ).then(get_only(Metal))
+        return get_planned_records(Metal, info).get(id=kwargs["id"])
     
 
     def resolve_metals(self, info, **kwargs):
-        try:
-            metals = self.metal_set.filter(**process_kwargs(kwargs))
-        except AttributeError:
-            metals = Metal.objects.filter(**process_kwargs(kwargs))
+        if self is not None:
+            return load_related(info, self.metal_set, kwargs)
+        metals = get_planned_records(Metal, info).filter(**process_kwargs(kwargs))
         if "sort" in kwargs: metals = metals.order_by(kwargs["sort"])
-        if "skip" in kwargs: metals = metals[kwargs["skip"]:]
         return metals
 
 
@@ -309,31 +710,35 @@ class ChainInteractionConnection(Connection):
         node = ChainInteractionType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasChainInteractions:
 
     chain_interaction = graphene.Field(ChainInteractionType, id=graphene.Int(required=True))
-    chain_interactions = graphene.ConnectionField(ChainInteractionConnection, **generate_args(ChainInteraction))
+    chain_interactions = RecordConnectionField(ChainInteractionConnection, **generate_args(ChainInteraction))
 
     def resolve_chain_interaction(self, info, **kwargs):
-        try:
-            return self.chaininteraction_set.get(id=kwargs["id"])
-        except AttributeError:
-            return ChainInteraction.objects.get(id=kwargs["id"])
+        if self is not None:
+            return load_related(
+             info, self.chaininteraction_set, {"id": kwargs["id"]}
+            ).then(get_only(ChainInteraction))
+        return get_planned_records(ChainInteraction, info).get(id=kwargs["id"])
     
 
     def resolve_chain_interactions(self, info, **kwargs):
-        try:
-            chaininteractions = self.chaininteraction_set.filter(**process_kwargs(kwargs))
-        except AttributeError:
-            chaininteractions = ChainInteraction.objects.filter(**process_kwargs(kwargs))
+        if self is not None:
+            return load_related(info, self.chaininteraction_set, kwargs)
+        chaininteractions = get_planned_records(ChainInteraction, info).filter(**process_kwargs(kwargs))
         if "sort" in kwargs: chaininteractions = chaininteractions.order_by(kwargs["sort"])
-        if "skip" in kwargs: chaininteractions = chaininteractions[kwargs["skip"]:]
         return chaininteractions
 
 
@@ -351,31 +756,36 @@ class ZincSiteConnection(Connection):
         node = ZincSiteType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasZincSites:
 
     zincsite = graphene.Field(ZincSiteType, id=graphene.String(required=True))
-    zincsites = graphene.ConnectionField(ZincSiteConnection, **generate_args(ZincSite))
+    zincsites = RecordConnectionField(ZincSiteConnection, term=graphene.String(), **generate_args(ZincSite))
 
     def resolve_zincsite(self, info, **kwargs):
-        try:
-            return self.zincsite_set.get(id=kwargs["id"])
-        except AttributeError:
-            return ZincSite.objects.get(id=kwargs["id"])
+        if self is not None:
+            return load_related(
+             info, self.zincsite_set, {"id": kwargs["id"]}
+            ).then(get_only(ZincSite))
+        return get_planned_records(ZincSite, info).get(id=kwargs["id"])
     
 
     def resolve_zincsites(self, info, **kwargs):
-        try:
-            zincsites = self.zincsite_set.filter(**process_kwargs(kwargs))
-        except AttributeError:
-            zincsites = ZincSite.objects.filter(**process_kwargs(kwargs))
+        if self is not None:
+            return load_related(info, self.zincsite_set, kwargs)
+        zincsites = get_planned_records(ZincSite, info).filter(**process_kwargs(kwargs))
+        if "term" in kwargs: zincsites = search_records(zincsites, kwargs["term"])
         if "sort" in kwargs: zincsites = zincsites.order_by(kwargs["sort"])
-        if "skip" in kwargs: zincsites = zincsites[kwargs["skip"]:]
         return zincsites
 
 
@@ -390,7 +800,19 @@ class GroupType(HasZincSites, DjangoObjectType):
     def resolve_site_count(self, info, **kwargs):
         try:
             return self.site_count
-        except: return self.zincsite_set.count()
+        except: return self.all_sites.count()
+    
+
+    def resolve_zincsite(self, info, **kwargs):
+        return load_children(
+         info, self, ZincSite, get_nesting_paths("group"), {"id": kwargs["id"]}
+        ).then(get_only(ZincSite))
+    
+
+    def resolve_zincsites(self, info, **kwargs):
+        return load_children(
+         info, self, ZincSite, get_nesting_paths("group"), kwargs
+        )
 
 
 
@@ -400,32 +822,38 @@ class GroupConnection(Connection):
         node = GroupType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasGroups:
 
     group = graphene.Field(GroupType, id=graphene.String(required=True))
-    groups = graphene.ConnectionField(GroupConnection, **generate_args(Group))
+    groups = RecordConnectionField(GroupConnection, term=graphene.String(), **generate_args(Group))
 
     def resolve_group(self, info, **kwargs):
         try:
             return self.group_set.get(id=kwargs["id"])
         except AttributeError:
-            return Group.objects.get(id=kwargs["id"])
+            return get_planned_records(Group, info).get(id=kwargs["id"])
     
 
     def resolve_groups(self, info, **kwargs):
         try:
             groups = self.group_set.filter(**process_kwargs(kwargs))
         except AttributeError:
-            groups = Group.objects.filter(**process_kwargs(kwargs))
-        groups = groups.annotate(site_count=Count("zincsite")).order_by("-site_count")
+            groups = get_planned_records(Group, info).filter(**process_kwargs(kwargs))
+        groups = filter_identity(groups, kwargs)
+        groups = groups.annotate(site_count=get_site_count(kwargs)).order_by("-site_count")
+        if "term" in kwargs: groups = search_records(groups, kwargs["term"])
         if "sort" in kwargs: groups = groups.order_by(kwargs["sort"])
-        if "skip" in kwargs: groups = groups[kwargs["skip"]:]
         return groups
 
 
@@ -443,31 +871,35 @@ class ChainConnection(Connection):
         node = ChainType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasChains:
 
     chain = graphene.Field(ChainType, id=graphene.String(required=True))
-    chains = graphene.ConnectionField(ChainConnection, **generate_args(Chain))
+    chains = RecordConnectionField(ChainConnection, **generate_args(Chain))
 
     def resolve_chain(self, info, **kwargs):
-        try:
-            return self.chain_set.get(id=kwargs["id"])
-        except AttributeError:
-            return Chain.objects.get(id=kwargs["id"])
+        if self is not None:
+            return load_related(
+             info, self.chain_set, {"id": kwargs["id"]}
+            ).then(get_only(Chain))
+        return get_planned_records(Chain, info).get(id=kwargs["id"])
     
 
     def resolve_chains(self, info, **kwargs):
-        try:
-            chains = self.chain_set.filter(**process_kwargs(kwargs))
-        except AttributeError:
-            chains = Chain.objects.filter(**process_kwargs(kwargs))
+        if self is not None:
+            return load_related(info, self.chain_set, kwargs)
+        chains = get_planned_records(Chain, info).filter(**process_kwargs(kwargs))
         if "sort" in kwargs: chains = chains.order_by(kwargs["sort"])
-        if "skip" in kwargs: chains = chains[kwargs["skip"]:]
         return chains
 
 
@@ -476,6 +908,18 @@ class ChainClusterType(HasChains, DjangoObjectType):
 
     class Meta:
         model = ChainCluster
+    
+
+    def resolve_chain(self, info, **kwargs):
+        return load_children(
+         info, self, Chain, get_nesting_paths("cluster"), {"id": kwargs["id"]}
+        ).then(get_only(Chain))
+    
+
+    def resolve_chains(self, info, **kwargs):
+        return load_children(
+         info, self, Chain, get_nesting_paths("cluster"), kwargs
+        )
 
 
 
@@ -485,31 +929,36 @@ class ChainClusterConnection(Connection):
         node = ChainClusterType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasChainClusters:
 
     chain_cluster = graphene.Field(ChainClusterType, id=graphene.String(required=True))
-    chain_clusters = graphene.ConnectionField(ChainClusterConnection, **generate_args(ChainCluster))
+    chain_clusters = RecordConnectionField(ChainClusterConnection, **generate_args(ChainCluster))
 
     def resolve_chain_cluster(self, info, **kwargs):
         try:
             return self.chaincluster_set.get(id=kwargs["id"])
         except AttributeError:
-            return ChainCluster.objects.get(id=kwargs["id"])
+            return get_planned_records(ChainCluster, info).get(id=kwargs["id"])
     
 
     def resolve_chain_clusters(self, info, **kwargs):
         try:
             chainclusters = self.chaincluster_set.filter(**process_kwargs(kwargs))
         except AttributeError:
-            chainclusters = ChainCluster.objects.filter(**process_kwargs(kwargs))
+            chainclusters = get_planned_records(ChainCluster, info).filter(**process_kwargs(kwargs))
+        chainclusters = filter_identity(chainclusters, kwargs)
         if "sort" in kwargs: chainclusters = chainclusters.order_by(kwargs["sort"])
-        if "skip" in kwargs: chainclusters = chainclusters[kwargs["skip"]:]
         return chainclusters
 
 
@@ -527,42 +976,33 @@ class PdbConnection(Connection):
         node = PdbType
     
     count = graphene.Int()
+    total_count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return count_records(self.records)
+    
+
+    def resolve_total_count(self, info, **kwargs):
+        return count_records(self.all_records)
 
 
 
 class HasPdbs:
 
     pdb = graphene.Field(PdbType, id=graphene.String(required=True))
-    pdbs = graphene.ConnectionField(PdbConnection, term=graphene.String(), **generate_args(Pdb))
+    pdbs = RecordConnectionField(PdbConnection, term=graphene.String(), **generate_args(Pdb))
 
     def resolve_pdb(self, info, **kwargs):
         try:
             return self.pdb_set.get(id=kwargs["id"])
         except AttributeError:
-            return Pdb.objects.get(id=kwargs["id"])
+            return get_planned_records(Pdb, info).get(id=kwargs["id"])
     
 
     def resolve_pdbs(self, info, **kwargs):
-        pdbs = Pdb.objects.filter(**process_kwargs(kwargs))
-        if "term" in kwargs:
-            pdbs = Pdb.objects.filter(
-             Q(id=kwargs["term"].upper()) | Q(title__contains=kwargs["term"].upper())
-             | Q(classification__contains=kwargs["term"].upper())
-             | Q(technique__contains=kwargs["term"].upper())
-             | Q(organism__contains=kwargs["term"].upper())
-             | Q(keywords__contains=kwargs["term"].upper())
-            )
+        pdbs = get_planned_records(Pdb, info).filter(**process_kwargs(kwargs))
+        if "term" in kwargs: pdbs = search_records(pdbs, kwargs["term"])
         if "sort" in kwargs: pdbs = pdbs.order_by(kwargs["sort"])
-        if "skip" in kwargs and "first" in kwargs:
-            pdbs = list(pdbs[kwargs["skip"]:kwargs["skip"] + kwargs["first"]])
-        elif "skip" in kwargs:
-            pdbs = pdbs[kwargs["skip"]:]
-        elif "first" in kwargs:
-            pdbs = pdbs[:kwargs["first"]]
-       
         return pdbs
     
 
@@ -585,7 +1025,7 @@ class BlastType(graphene.ObjectType):
     chain = graphene.Field(ChainType)
 
     def resolve_chain(self, info, **kwargs):
-        return Chain.objects.get(id=self.title.split("|")[1])
+        return get_planned_records(Chain, info).get(id=self.title.split("|")[1])
 
 
 
@@ -597,7 +1037,27 @@ class BlastConnection(Connection):
     count = graphene.Int()
 
     def resolve_count(self, info, **kwargs):
-        return len(self.edges)
+        return len(self.iterable)
+
+
+
+def get_stats_points(statistic, cutoff=None):
+    """Gets the counts of one of the statistics saved when the database was
+    built, in one query. If a cutoff is given, only that many of the most
+    common labels are kept, and the rest are added together as OTHER."""
+
+    counts = StatsCount.objects.filter(statistic=statistic)
+    if cutoff is None:
+        return [StatsPoint(label, count) for label, count in
+         counts.order_by("rank").values_list("label", "count")]
+    counts = counts.annotate(position=Least("rank", Value(cutoff))).values(
+     "position"
+    ).annotate(first_label=Min("label"), total=Sum("count")).order_by("position")
+    points = [StatsPoint(
+     "OTHER" if c["position"] == cutoff else c["first_label"], c["total"]
+    ) for c in counts]
+    if len(points) <= cutoff: points.append(StatsPoint("OTHER", 0))
+    return points
 
 
 
@@ -629,59 +1089,31 @@ class Stats(graphene.ObjectType):
     
 
     def resolve_unique_site_count(self, info, **kwargs):
-        return Group.objects.all().count()
+        return filter_identity(Group.objects.all(), {}).count()
     
 
     def resolve_residue_counts(self, info, **kwargs):
-        names = Residue.objects.filter(site__representative=True, primary=True).values_list("name")
-        counts = [[n[0], c] for n, c in Counter(names).most_common()]
-        cutoff = kwargs["cutoff"]
-        counts = counts[:cutoff] + [["OTHER", sum(n[1] for n in counts[cutoff:])]]
-        return [StatsPoint(l[0], l[1]) for l in counts]
+        return get_stats_points("residues", kwargs["cutoff"])
     
 
     def resolve_technique_counts(self, info, **kwargs):
-        sites = ZincSite.objects.all().annotate(technique=F("pdb__technique"))
-        counts = Counter([site.technique.upper() for site in sites]).most_common()
-        cutoff = kwargs["cutoff"]
-        counts = counts[:cutoff] + [["OTHER", sum(n[1] for n in counts[cutoff:])]]
-        return [StatsPoint(l[0], l[1]) for l in counts]
+        return get_stats_points("techniques", kwargs["cutoff"])
     
 
     def resolve_species_counts(self, info, **kwargs):
-        sites = ZincSite.objects.all().annotate(organism=F("pdb__organism"))
-        counts = Counter([str(site.organism).upper() for site in sites]).most_common()
-        cutoff = kwargs["cutoff"]
-        counts = counts[:cutoff] + [["OTHER", sum(n[1] for n in counts[cutoff:])]]
-        return [StatsPoint(l[0], l[1]) for l in counts]
+        return get_stats_points("species", kwargs["cutoff"])
     
 
     def resolve_classification_counts(self, info, **kwargs):
-        sites = ZincSite.objects.all().annotate(classification=F("pdb__classification"))
-        counts = Counter([site.classification.upper() for site in sites]).most_common()
-        cutoff = kwargs["cutoff"]
-        counts = counts[:cutoff] + [["OTHER", sum(n[1] for n in counts[cutoff:])]]
-        return [StatsPoint(l[0], l[1]) for l in counts]
+        return get_stats_points("classifications", kwargs["cutoff"])
     
 
     def resolve_families_counts(self, info, **kwargs):
-        sites = ZincSite.objects.filter(representative=True)
-        counts = Counter([site.family.upper() for site in sites]).most_common()
-        cutoff = kwargs["cutoff"]
-        counts = counts[:cutoff] + [["OTHER", sum(n[1] for n in counts[cutoff:])]]
-        return [StatsPoint(l[0], l[1]) for l in counts]
+        return get_stats_points("families", kwargs["cutoff"])
     
 
     def resolve_resolution_counts(self, info, **kwargs):
-        sites = ZincSite.objects.all().annotate(resolution=F("pdb__resolution"))
-        return [
-         StatsPoint("<1.5Å", sites.filter(resolution__lt=1.5).count()),
-         StatsPoint("1.5-2.0Å", sites.filter(resolution__lt=2.0, resolution__gte=1.5).count()),
-         StatsPoint("2.0-2.5Å", sites.filter(resolution__lt=2.5, resolution__gte=2.0).count()),
-         StatsPoint("2.5-3.0Å", sites.filter(resolution__lt=3.0, resolution__gte=2.5).count()),
-         StatsPoint("3.0Å+", sites.filter(resolution__gte=3.0).count()),
-         StatsPoint("NONE", sites.filter(resolution=None).count())
-        ]
+        return get_stats_points("resolutions")
 
 
 
@@ -690,12 +1122,13 @@ class Query(HasPdbs, HasZincSites, HasMetals, HasResidues, HasAtoms, HasChains,
             HasStabilisingBonds, HasChainInteractions, graphene.ObjectType):
    
     version = graphene.String()
-    blast = graphene.ConnectionField(
+    blast = RecordConnectionField(
      BlastConnection, sequence=graphene.String(required=True),
      evalue=graphene.Float(), skip=graphene.Int()
     )
     stats = graphene.Field(Stats)
     families = graphene.List(graphene.String)
+    sequence_identities = graphene.List(graphene.Float)
     
     def resolve_version(self, info, **kwargs):
         return settings.VERSION
@@ -711,8 +1144,15 @@ class Query(HasPdbs, HasZincSites, HasMetals, HasResidues, HasAtoms, HasChains,
     
 
     def resolve_families(self, info, **kwargs):
-        families = Counter(Group.objects.all().values_list("family", flat=True))
-        return [f"{k}-{v}" for k, v in families.most_common()]
+        return [f"{label}-{count}" for label, count in StatsCount.objects.filter(
+         statistic="group_families"
+        ).order_by("rank").values_list("label", "count")]
+    
+
+    def resolve_sequence_identities(self, info, **kwargs):
+        return sorted(set(ChainCluster.objects.values_list(
+         "identity", flat=True
+        )), reverse=True)
     
     
 schema = graphene.Schema(query=Query)
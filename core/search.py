@@ -0,0 +1,57 @@
+"""Contains the full-text search indexes of PDBs, groups and zinc sites. These
+are SQLite FTS5 tables, which the build scripts fill from the records they
+index once they have finished."""
+
+import re
+from django.db import connection, transaction
+from django.db.models import F
+from .models import Pdb, Group, ZincSite
+
+SEARCH_INDEXES = {
+ Pdb: ("pdbs_search", ["title", "classification", "technique", "organism",
+  "keywords"], """SELECT id, id, title, classification, technique,
+  organism, keywords FROM PDBs"""),
+ Group: ("groups_search", ["family", "keywords", "classifications"],
+  """SELECT id, id, family, keywords, classifications FROM groups"""),
+ ZincSite: ("zinc_sites_search", ["family", "residue_names", "title",
+  "classification", "organism", "keywords"], """SELECT zinc_sites.id,
+  zinc_sites.id, family, residue_names, title, classification, organism,
+  keywords FROM zinc_sites INNER JOIN PDBs ON zinc_sites.pdb_id = PDBs.id""")
+}
+
+def update_search_indexes(models=None):
+    """Fills the search indexes of some models (or of all of them) again from
+    their records."""
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for Model in models or SEARCH_INDEXES:
+            table, columns, select = SEARCH_INDEXES[Model]
+            cursor.execute(f"DELETE FROM {table}")
+            cursor.execute(f"INSERT INTO {table} {select}")
+
+
+def get_match_expression(term, columns):
+    """Turns a search term into an FTS5 query which matches text in the given
+    columns containing every word in it, with the words allowed to be the
+    start of longer ones, or which matches the record's code exactly. Each
+    word is quoted, so nothing in the term is taken as query syntax."""
+
+    words = re.findall(r"\w+", term)
+    if not words: return ""
+    return '{{{}}} : ({}) OR code : "{}"'.format(
+     " ".join(columns), " ".join('"{}"*'.format(word) for word in words),
+     " ".join(words)
+    )
+
+
+def search_records(records, term):
+    """Narrows a queryset down to the records whose search index entries match
+    a search term, and orders them by how well they match, best first, using
+    FTS5's bm25 rank. The rank is available as search_rank."""
+
+    columns = SEARCH_INDEXES[records.model][1]
+    expression = get_match_expression(term, columns)
+    if not expression: return records.none()
+    return records.filter(search_entry__index__match=expression).annotate(
+     search_rank=F("search_entry__rank")
+    ).order_by("search_rank")
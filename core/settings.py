@@ -15,6 +15,17 @@ DEBUG = True
 
 ROOT_URLCONF = "core.urls"
 
+# Chains are clustered at each of these sequence identities, most specific first
+SEQUENCE_IDENTITIES = [0.9, 0.7, 0.5]
+
+# Connections return the default number of records unless asked for more, up to
+# the maximum, and queries estimated to fetch more records, or to nest them more
+# deeply, than the limits here are rejected before they are run
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_QUERY_DEPTH = 8
+MAX_QUERY_COST = 100000
+
 INSTALLED_APPS = [
  "django.contrib.contenttypes",
  "corsheaders",
@@ -39,11 +50,24 @@ if DEBUG:
      "ENGINE": "django.db.backends.sqlite3",
      "NAME": os.path.join(BASE_DIR, "data", "db.sqlite3")
     }}
+    STRUCTURE_CACHE = os.path.join(BASE_DIR, "data", "structures")
+    RESPONSE_CACHE = os.path.join(BASE_DIR, "data", "responses")
 else:
     DATABASES = {"default": {
      "ENGINE": "django.db.backends.sqlite3",
      "NAME": os.path.join(BASE_DIR, "..", "data", "db.sqlite3")
     }}
+    STRUCTURE_CACHE = os.path.join(BASE_DIR, "..", "data", "structures")
+    RESPONSE_CACHE = os.path.join(BASE_DIR, "..", "data", "responses")
+
+# GraphQL responses are kept on disk, so that every worker process shares them,
+# for a week after they are first sent
+CACHES = {"default": {
+ "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+ "LOCATION": RESPONSE_CACHE,
+ "TIMEOUT": 60 * 60 * 24 * 7,
+ "OPTIONS": {"MAX_ENTRIES": 20000}
+}}
 
 STATIC_URL = "/static/"
 STATIC_ROOT = os.path.abspath(f"{BASE_DIR}/../static")
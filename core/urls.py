@@ -1,6 +1,9 @@
-from graphene_django.views import GraphQLView
 from django.urls import path
+from .views import CachedGraphQLView
+from .cost import CostLimitedBackend
 
 urlpatterns = [
- path("", GraphQLView.as_view(graphiql=True)),
+ path("", CachedGraphQLView.as_view(
+  graphiql=True, backend=CostLimitedBackend()
+ )),
 ]
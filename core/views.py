@@ -0,0 +1,50 @@
+import json
+import hashlib
+from django.core.cache import cache
+from graphene_django.views import GraphQLView
+from graphql import parse, print_ast
+from .models import DatabaseVersion
+
+class CachedGraphQLView(GraphQLView):
+    """A GraphQL view which remembers the responses it sends, so that the same
+    query asked again is answered without running it. The data only changes
+    when the database is built or clustered, which gives it a new version
+    stamp, and responses are remembered under that stamp - so those from older
+    versions of the database are never sent. Responses which had errors are
+    not remembered, and neither is anything if the database has no stamp."""
+
+    def get_cache_key(self, request, data, show_graphiql):
+        """Works out what a response would be remembered under, from the
+        query, with its layout normalised, the variables and operation name,
+        and the database version stamp. If the response shouldn't be
+        remembered, None is returned."""
+
+        query, variables, operation_name, id = self.get_graphql_params(request, data)
+        stamp = DatabaseVersion.get_stamp()
+        if not query or not stamp: return None
+        try:
+            query = print_ast(parse(query))
+        except Exception: return None
+        key = json.dumps(
+         [stamp, query, variables, operation_name, show_graphiql],
+         sort_keys=True, default=str
+        )
+        return "graphql:" + hashlib.sha256(key.encode()).hexdigest()
+
+
+    def get_response(self, request, data, show_graphiql=False):
+        key = self.get_cache_key(request, data, show_graphiql)
+        if key is not None:
+            cached = cache.get(key)
+            if cached is not None: return cached
+        self.cacheable = False
+        response = GraphQLView.get_response(self, request, data, show_graphiql)
+        if key is not None and self.cacheable and response[1] == 200:
+            cache.set(key, response)
+        return response
+
+
+    def execute_graphql_request(self, *args, **kwargs):
+        result = GraphQLView.execute_graphql_request(self, *args, **kwargs)
+        self.cacheable = result is not None and not result.errors
+        return result
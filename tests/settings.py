@@ -0,0 +1,9 @@
+"""Settings for running the tests, which are the normal settings except that
+responses aren't remembered - tests neither fill the response cache on disk
+nor see each other's responses. Tests of the cache itself override this."""
+
+from core.settings import *
+
+CACHES = {"default": {
+ "BACKEND": "django.core.cache.backends.dummy.DummyCache"
+}}
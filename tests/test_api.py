@@ -1,5 +1,10 @@
 import kirjava
-from django.test import LiveServerTestCase
+from django.test import LiveServerTestCase, override_settings
+from django.http import HttpRequest
+from django.core.cache import cache
+from core.models import ChainCluster, Group, ZincSite, Pdb, DatabaseVersion
+from core.schema import schema
+from core.search import update_search_indexes
 
 class ApiTest(LiveServerTestCase):
 
@@ -82,6 +87,18 @@ class GroupApiTests(ApiTest):
          {"node": {"id": "12CA-1", "family": "H3"}}, {"node": {"id": "5Y5B-1", "family": "C1D1H4"}}
         ]}}})
 
+    
+    def test_can_get_groups_at_other_identities(self):
+        parent = Group.objects.create(id="12CA-1-70", family="H3", identity=0.7)
+        Group.objects.filter(id__in=["12CA-1", "1IZB-1"]).update(parent=parent)
+        data = self.client.execute("""{groups(identity: 0.7) { edges { node { 
+         id siteCount zincsites { count } children { id }
+        }}}}""")
+        self.assertEqual(data, {"data": {"groups": {"edges": [{"node": {
+         "id": "12CA-1-70", "siteCount": 9, "zincsites": {"count": 9},
+         "children": [{"id": "12CA-1"}, {"id": "1IZB-1"}]
+        }}]}}})
+
 
 
 class ZincSiteApiTests(ApiTest):
@@ -250,6 +267,20 @@ class ChainClusterApiTests(ApiTest):
         self.assertEqual(data, {"data": {"chainClusters": {"count": 2, "edges": [
          {"node": {"id": "12CAA"}}, {"node": {"id": "1IZBB"}}
         ]}}})
+    
+
+    def test_can_get_chain_clusters_at_other_identities(self):
+        parent = ChainCluster.objects.create(id="12CAA-70", identity=0.7)
+        ChainCluster.objects.filter(id__in=["12CAA", "1IZBB"]).update(parent=parent)
+        data = self.client.execute("""{ chainClusters(identity: 0.7) { count edges { node {
+         id chains { count } children { id }
+        }}}}""")
+        self.assertEqual(data, {"data": {"chainClusters": {"count": 1, "edges": [{"node": {
+         "id": "12CAA-70", "chains": {"count": 9},
+         "children": [{"id": "12CAA"}, {"id": "1IZBB"}]
+        }}]}}})
+        data = self.client.execute("""{ sequenceIdentities }""")
+        self.assertEqual(data, {"data": {"sequenceIdentities": [0.9, 0.7]}})
 
 
 
@@ -594,3 +625,171 @@ class CoordinateBondApiTests(ApiTest):
          {"node": {"id": "2", "atom": {"id": "30"}}},
          {"node": {"id": "3", "atom": {"id": "7"}}}
         ]}}}})
+
+
+
+class NestedQueryTests(ApiTest):
+
+    def test_nested_records_are_fetched_one_level_at_a_time(self):
+        with self.assertNumQueries(3):
+            result = schema.execute("""{zincsites(sort: "id") { edges { node {
+             id residues(sort: "-id", skip: 1) { edges { node {
+              id atoms(name: "CA") { count }
+             }}}
+            }}}}""", context_value=HttpRequest())
+        self.assertEqual(result.data, {"zincsites": {"edges": [{"node": {
+         "id": site.id, "residues": {"edges": [{"node": {
+          "id": str(residue.id),
+          "atoms": {"count": residue.atom_set.filter(name="CA").count()}
+         }} for residue in site.residue_set.order_by("-id")[1:]]}
+        }} for site in ZincSite.objects.order_by("id")]}})
+
+
+    def test_related_records_asked_for_are_fetched_with_their_records(self):
+        with self.assertNumQueries(2):
+            result = schema.execute("""{zincsites(sort: "id") { edges { node {
+             id pdb { title } metalSet { element }
+            }}}}""", context_value=HttpRequest())
+        self.assertEqual(result.data, {"zincsites": {"edges": [{"node": {
+         "id": site.id, "pdb": {"title": site.pdb.title},
+         "metalSet": [{"element": m.element} for m in site.metal_set.order_by("id")]
+        }} for site in ZincSite.objects.order_by("id")]}})
+
+
+
+class PaginationTests(ApiTest):
+
+    def test_can_count_records_beyond_page(self):
+        data = self.client.execute("""{pdbs(title__contains: "INSULIN", skip: 1, first: 1) {
+         count totalCount edges { node { id }}
+        }}""")
+        self.assertEqual(data, {"data": {"pdbs": {
+         "count": 2, "totalCount": 3, "edges": [{"node": {"id": "1MSO"}}]
+        }}})
+
+
+    def test_can_page_through_records_with_cursors(self):
+        ids, after = [], ""
+        while True:
+            data = self.client.execute("""{residues(sort: "-name"%s, first: 10) {
+             pageInfo { hasNextPage endCursor } edges { node { id }}
+            }}""" % after)["data"]["residues"]
+            ids += [edge["node"]["id"] for edge in data["edges"]]
+            if not data["pageInfo"]["hasNextPage"]: break
+            after = ', after: "%s"' % data["pageInfo"]["endCursor"]
+        data = self.client.execute("""{residues(sort: "-name") { edges { node { id }}}}""")
+        self.assertEqual(ids, [e["node"]["id"] for e in data["data"]["residues"]["edges"]])
+        self.assertEqual(len(ids), 83)
+
+
+
+
+@override_settings(CACHES={"default": {
+ "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+}})
+class ResponseCacheTests(ApiTest):
+
+    def setUp(self):
+        ApiTest.setUp(self)
+        cache.clear()
+    
+
+    def test_responses_are_remembered_until_database_changes(self):
+        DatabaseVersion.bump()
+        data = self.client.execute("""{pdb(id: "1XDA") { title }}""")
+        Pdb.objects.filter(id="1XDA").update(title="NEW TITLE")
+        self.assertEqual(self.client.execute("""{pdb(id: "1XDA") {
+         title
+        }}"""), data)
+        DatabaseVersion.bump()
+        self.assertEqual(self.client.execute("""{pdb(id: "1XDA") { title }}"""), {
+         "data": {"pdb": {"title": "NEW TITLE"}}
+        })
+    
+
+    def test_responses_are_not_remembered_without_database_version(self):
+        self.client.execute("""{pdb(id: "1XDA") { title }}""")
+        Pdb.objects.filter(id="1XDA").update(title="NEW TITLE")
+        self.assertEqual(self.client.execute("""{pdb(id: "1XDA") { title }}"""), {
+         "data": {"pdb": {"title": "NEW TITLE"}}
+        })
+
+
+
+class SearchTests(ApiTest):
+
+    def setUp(self):
+        ApiTest.setUp(self)
+        update_search_indexes()
+    
+
+    def test_can_search_pdbs(self):
+        data = self.client.execute("""{pdbs(term: "insul") { count edges { node { id }}}}""")
+        self.assertEqual(data, {"data": {"pdbs": {"count": 3, "edges": [
+         {"node": {"id": "1XDA"}}, {"node": {"id": "1IZB"}}, {"node": {"id": "1MSO"}}
+        ]}}})
+        data = self.client.execute("""{pdbs(term: "human insulin") { edges { node { id }}}}""")
+        self.assertEqual(data, {"data": {"pdbs": {"edges": [{"node": {"id": "1MSO"}}]}}})
+
+
+    def test_can_search_pdbs_by_code(self):
+        data = self.client.execute("""{pdbs(term: "1xda") { count edges { node { id }}}}""")
+        self.assertEqual(data, {"data": {"pdbs": {"count": 1, "edges": [{"node": {"id": "1XDA"}}]}}})
+        data = self.client.execute("""{pdbs(term: "1xd") { count }}""")
+        self.assertEqual(data, {"data": {"pdbs": {"count": 0}}})
+
+
+    def test_can_search_groups_and_zincsites(self):
+        data = self.client.execute("""{groups(term: "lyase") { edges { node { id }}}}""")
+        self.assertEqual(data, {"data": {"groups": {"edges": [{"node": {"id": "12CA-1"}}]}}})
+        data = self.client.execute("""{pdb(id: "1DEH") { zincsites(term: "cys his") {
+         edges { node { id }}
+        }}}""")
+        self.assertEqual(data, {"data": {"pdb": {"zincsites": {"edges": [
+         {"node": {"id": "1DEH-2"}}, {"node": {"id": "1DEH-4"}}
+        ]}}}})
+
+
+
+class QueryLimitTests(ApiTest):
+
+    @override_settings(DEFAULT_PAGE_SIZE=5)
+    def test_connections_return_default_page_size(self):
+        data = self.client.execute("""{residues {
+         count pageInfo { hasNextPage } edges { node { id }}
+        }}""")["data"]["residues"]
+        self.assertEqual(len(data["edges"]), 5)
+        self.assertEqual(data["count"], 83)
+        self.assertTrue(data["pageInfo"]["hasNextPage"])
+
+
+    def test_page_size_cannot_be_more_than_maximum(self):
+        data = self.client.execute("""{residues(first: 1001) { edges { node { id }}}}""")
+        self.assertNotIn("data", data)
+        self.assertEqual(data["errors"][0]["message"], "first cannot be more than 1000")
+
+
+    @override_settings(MAX_QUERY_DEPTH=3)
+    def test_deeply_nested_queries_are_rejected(self):
+        query = """{pdb(id: "1XDA") { zincsites { edges { node {
+         residues { edges { node { %s }}}
+        }}}}}"""
+        data = self.client.execute(query % "id")
+        self.assertEqual(len(data["data"]["pdb"]["zincsites"]["edges"]), 2)
+        data = self.client.execute(query % "atoms { edges { node { id }}}")
+        self.assertNotIn("data", data)
+        self.assertEqual(data["errors"][0]["message"],
+         "Query nests records 4 deep, but they can only be nested 3 deep")
+
+
+    @override_settings(MAX_QUERY_COST=50)
+    def test_expensive_queries_are_rejected(self):
+        data = self.client.execute("""{pdbs(first: 10) { edges { node { id }}}}""")
+        self.assertEqual(len(data["data"]["pdbs"]["edges"]), 10)
+        data = self.client.execute("""{pdbs(first: 10) { edges { node {
+         zincsites { edges { node { residues { edges { node { id }}}}}}
+        }}}}""")
+        self.assertNotIn("data", data)
+        self.assertTrue(data["errors"][0]["message"].startswith(
+         "Query would fetch an estimated"
+        ))
@@ -1,11 +1,28 @@
 import sys; sys.path.append("build")
+import os
+import json
+import random
+from itertools import combinations
 from datetime import date
+from tempfile import TemporaryDirectory
 from collections import Counter
-from unittest.mock import patch, Mock, MagicMock
-from django.test import LiveServerTestCase
+from unittest.mock import patch, Mock, MagicMock, mock_open
+from django.test import LiveServerTestCase, SimpleTestCase, TransactionTestCase
+from django.test import TestCase
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
 from core.models import Pdb, Chain, ZincSite, ChainCluster, Group
+from core.models import ManifestEntry, JournalEntry, StatsCount
 from build.build import main as build_main
 from build.cluster import main as cluster_main
+from sites import merge_metal_groups, check_sites_have_unique_residues
+from sites import get_site_residues, PdbIndex
+from utilities import get_best_model
+from atomium.structures import Atom, Residue, Chain as AtomiumChain, Ligand, Model
+from atomium.data import File
+from chains import align_sequences, match_score, parse_cluster_file
+from chains import get_cd_hit_resources, run_cd_hit
+from kmer import cluster_sequences, match_sequences
 
 class DatabaseBuildingTests(LiveServerTestCase):
 
@@ -43,6 +60,38 @@ class DatabaseBuildingTests(LiveServerTestCase):
         self.check_print_statement("1 of these need to be checked")
 
 
+    @patch("build.build.get_pdb_revisions")
+    def test_incremental_build_checks_only_changed(self, mock_revisions):
+        Pdb.objects.create(id="1SP1", skeleton=False)
+        Pdb.objects.create(id="3ZNF", skeleton=False)
+        ManifestEntry.objects.create(id="3ZNF", revision="1.0")
+        self.mock_codes.return_value = ["3ZNF", "6EQU"]
+        mock_revisions.return_value = {"3ZNF": "1.0", "6EQU": "1.1"}
+        build_main(incremental=True)
+        self.check_print_statement("Deleted 1 obsolete PDBs")
+        self.check_print_statement("1 of these need to be checked")
+        self.assertFalse(Pdb.objects.filter(id="1SP1").exists())
+        self.assertEqual(Pdb.objects.count(), 2)
+        self.assertTrue(ManifestEntry.objects.filter(id="6EQU").exists())
+
+
+    def test_can_resume_and_retry_failed(self):
+        JournalEntry.objects.create(id="6EQU", state="pending")
+        JournalEntry.objects.create(id="XXXX", state="failed", attempts=3)
+        JournalEntry.objects.create(id="YYYY", state="failed", attempts=1)
+        build_main(resume=True)
+        self.check_print_statement("Resuming with 3 unfinished PDB codes")
+        self.check_print_statement("Skipping 1 PDBs that failed previously")
+        self.assertTrue(Pdb.objects.filter(id="6EQU").exists())
+        self.assertEqual(JournalEntry.objects.get(id="6EQU").state, "done")
+        self.assertEqual(JournalEntry.objects.get(id="YYYY").attempts, 2)
+        build_main(resume=True, retry_failed=4)
+        failed = JournalEntry.objects.get(id="XXXX")
+        self.assertEqual(failed.state, "failed")
+        self.assertEqual(failed.attempts, 4)
+        self.assertTrue(failed.traceback)
+
+
     def test_can_get_best_model(self):
         self.mock_codes.return_value = ["1B21"]
         build_main()
@@ -147,6 +196,41 @@ class DatabaseBuildingTests(LiveServerTestCase):
         self.assertEqual(len([r for r in chain_interaction_b.sequence if r.isupper()]), 3)
     
 
+    def test_can_process_codes_with_multiple_workers(self):
+        self.mock_codes.return_value = ["1B0N", "6EQU", "XXXX"]
+        build_main(workers=2)
+        self.assertEqual(Pdb.objects.count(), 2)
+        pdb = Pdb.objects.get(id="1B0N")
+        self.assertEqual(pdb.chain_set.count(), 2)
+        self.assertEqual(pdb.zincsite_set.get(id="1B0N-1").chaininteraction_set.count(), 2)
+        self.check_print_statement("XXXX")
+
+
+    def test_can_process_long_chains_with_multiple_workers(self):
+        self.mock_codes.return_value = ["6H8P", "6EQU"]
+        build_main(workers=2)
+        self.assertEqual(Pdb.objects.count(), 2)
+        self.assertEqual(JournalEntry.objects.filter(state="done").count(), 2)
+        chain = Pdb.objects.get(id="6H8P").chain_set.first()
+        self.assertGreater(len(chain.sequence), 300)
+        self.assertTrue(StatsCount.objects.filter(statistic="rows").exists())
+
+
+    def test_can_build_offline_from_structure_cache(self):
+        self.mock_codes.return_value = ["6EQU"]
+        with TemporaryDirectory() as cache_dir:
+            with self.settings(STRUCTURE_CACHE=cache_dir):
+                build_main()
+                self.assertTrue(os.listdir(cache_dir)[0].startswith("6equ_"))
+                Pdb.objects.all().delete()
+                with patch("cache.requests.get") as mock_get:
+                    build_main(offline=True)
+                    self.assertFalse(mock_get.called)
+        pdb = Pdb.objects.get(id="6EQU")
+        self.assertEqual(pdb.zincsite_set.count(), 1)
+        self.assertEqual(pdb.chain_set.count(), 1)
+
+
     def test_can_work_properly(self):
         self.mock_codes.return_value = ["6EQU"]
         build_main()
@@ -247,7 +331,7 @@ class DatabaseClusteringTests(LiveServerTestCase):
         cluster_main()
 
         # Chain clusters are correct
-        self.assertEqual(ChainCluster.objects.count(), 5)
+        self.assertEqual(ChainCluster.objects.filter(identity=0.9).count(), 5)
         anhydrase_cluster = ChainCluster.objects.get(id="12CAA")
         anhydrase_chains = anhydrase_cluster.chain_set.all()
         self.assertEqual(anhydrase_chains.count(), 3)
@@ -259,7 +343,7 @@ class DatabaseClusteringTests(LiveServerTestCase):
         self.assertEqual(dehydro_chains.count(), 4)
 
         # Groupsare correct
-        self.assertEqual(Group.objects.count(), 6)
+        self.assertEqual(Group.objects.filter(identity=0.9).count(), 6)
         anhydrase = Group.objects.get(id="12CA-1")
         anhydrase_sites = anhydrase.zincsite_set.all()
         self.assertEqual(anhydrase_sites.count(), 3)
@@ -270,3 +354,400 @@ class DatabaseClusteringTests(LiveServerTestCase):
         dehydro_sites = dehydro.zincsite_set.all()
         self.assertEqual(dehydro_sites.count(), 4)
 
+        # Clusters and groups are nested at lower identities
+        for identity in (0.7, 0.5):
+            self.assertEqual(ChainCluster.objects.filter(identity=identity).count(), 5)
+            self.assertEqual(Group.objects.filter(identity=identity).count(), 6)
+        anhydrase_70 = ChainCluster.objects.get(id="12CAA-70")
+        self.assertEqual(anhydrase_cluster.parent, anhydrase_70)
+        self.assertEqual(anhydrase_70.parent.id, "12CAA-50")
+        self.assertEqual(anhydrase_70.parent.all_chains.count(), 3)
+        self.assertEqual(Group.objects.get(id="12CA-1-50").all_sites.count(), 3)
+
+
+    @patch("builtins.print")
+    @patch("build.cluster.tqdm")
+    @patch("build.sites.tqdm")
+    def test_can_cluster_incrementally(self, mock_tqdm1, mock_tqdm2, mock_print):
+        mock_tqdm1.side_effect = lambda l: l
+        mock_tqdm2.side_effect = lambda l: l
+        cluster_main()
+        clusters = dict(Chain.objects.values_list("id", "cluster"))
+        groups = dict(ZincSite.objects.values_list("id", "group"))
+
+        # Some chains and sites are new
+        Chain.objects.filter(pdb__id__in=["1IZB", "3HUD"]).update(cluster=None)
+        ZincSite.objects.filter(pdb__id__in=["1IZB", "3HUD"]).update(
+         group=None, representative=False
+        )
+
+        # Cluster them into the existing clusters and groups
+        cluster_main(incremental=True)
+        self.assertEqual(ChainCluster.objects.filter(identity=0.9).count(), 5)
+        self.assertEqual(Group.objects.filter(identity=0.9).count(), 6)
+        self.assertEqual(dict(Chain.objects.values_list("id", "cluster")), clusters)
+        self.assertEqual(dict(ZincSite.objects.values_list("id", "group")), groups)
+        for group in Group.objects.filter(identity=0.9):
+            self.assertEqual(group.zincsite_set.get(representative=True).id, group.id)
+
+
+    @patch("builtins.print")
+    @patch("build.cluster.tqdm")
+    @patch("build.sites.tqdm")
+    def test_can_cluster_without_cd_hit(self, mock_tqdm1, mock_tqdm2, mock_print):
+        mock_tqdm1.side_effect = lambda l: l
+        mock_tqdm2.side_effect = lambda l: l
+        with open("core/fixtures/post-cluster.json") as f:
+            records = json.load(f)
+        clusters = {r["pk"]: r["fields"]["cluster"] for r in records
+         if r["model"] == "core.chain"}
+        groups = {r["pk"]: r["fields"]["group"] for r in records
+         if r["model"] == "core.zincsite"}
+
+        # The k-mer clusterer agrees with CD-HIT
+        cluster_main(backend="kmer")
+        self.assertEqual(dict(Chain.objects.values_list("id", "cluster")), clusters)
+        self.assertEqual(dict(ZincSite.objects.values_list("id", "group")), groups)
+
+
+    @patch("builtins.print")
+    @patch("build.cluster.tqdm")
+    @patch("build.sites.tqdm")
+    def test_clusters_are_replaced_at_the_end(self, mock_tqdm1, mock_tqdm2, mock_print):
+        mock_tqdm1.side_effect = lambda l: l
+        mock_tqdm2.side_effect = lambda l: l
+        from backends import KmerBackend
+        cluster_main(backend="kmer")
+        def get_clustering():
+            return (
+             sorted(ChainCluster.objects.values_list("id", "identity", "parent")),
+             sorted(Group.objects.values_list("id", "identity", "parent")),
+             dict(ZincSite.objects.values_list("id", "group"))
+            )
+        clustering = get_clustering()
+
+        # The database is unchanged while clustering is under way
+        cluster = KmerBackend.cluster
+        def check_and_cluster(backend, *args):
+            self.assertEqual(get_clustering(), clustering)
+            return cluster(backend, *args)
+        with patch.object(KmerBackend, "cluster", check_and_cluster):
+            cluster_main(backend="kmer")
+        self.assertEqual(get_clustering(), clustering)
+        self.assertEqual(Group.objects.filter(zincsite__representative=True).count(), 6)
+
+
+    @patch("builtins.print")
+    @patch("build.cluster.tqdm")
+    @patch("build.sites.tqdm")
+    def test_clusters_are_kept_if_sites_change_meanwhile(self, mock_tqdm1, mock_tqdm2, mock_print):
+        mock_tqdm1.side_effect = lambda l: l
+        mock_tqdm2.side_effect = lambda l: l
+        from backends import KmerBackend
+        cluster_main(backend="kmer")
+        clusters = sorted(ChainCluster.objects.values_list("id", "parent"))
+        groups = sorted(Group.objects.values_list("id", "parent"))
+        cluster = KmerBackend.cluster
+        def delete_and_cluster(backend, *args):
+            ZincSite.objects.filter(id="1IZB-1").delete()
+            return cluster(backend, *args)
+        with patch.object(KmerBackend, "cluster", delete_and_cluster):
+            with self.assertRaises(Exception):
+                cluster_main(backend="kmer")
+        self.assertEqual(sorted(ChainCluster.objects.values_list("id", "parent")), clusters)
+        self.assertEqual(sorted(Group.objects.values_list("id", "parent")), groups)
+
+
+    @patch("builtins.print")
+    @patch("build.cluster.tqdm")
+    @patch("build.sites.tqdm")
+    def test_clustering_saves_homepage_stats(self, mock_tqdm1, mock_tqdm2, mock_print):
+        mock_tqdm1.side_effect = lambda l: l
+        mock_tqdm2.side_effect = lambda l: l
+        cluster_main(backend="kmer")
+        def get_stats(statistic):
+            return list(StatsCount.objects.filter(
+             statistic=statistic
+            ).order_by("rank").values_list("label", "count"))
+        self.assertEqual(get_stats("residues"), [
+         ("HIS", 11), ("CYS", 10), ("HOH", 6), ("ASP", 1), ("SO4", 1)
+        ])
+        self.assertEqual(get_stats("group_families"), [
+         ("H3", 2), ("C4", 1), ("C2H1", 1), ("C1D1H4", 1), ("C3", 1)
+        ])
+        self.assertEqual(sum(c for l, c in get_stats("resolutions")), 19)
+
+
+    @patch("builtins.print")
+    @patch("build.cluster.tqdm")
+    @patch("build.sites.tqdm")
+    def test_undated_pdbs_are_clustered_last(self, mock_tqdm1, mock_tqdm2, mock_print):
+        mock_tqdm1.side_effect = lambda l: l
+        mock_tqdm2.side_effect = lambda l: l
+        Pdb.objects.filter(id="12CA").update(deposition_date=None)
+        cluster_main(backend="kmer")
+        cluster = Chain.objects.get(id="12CAA").cluster
+        self.assertEqual(cluster.chain_set.count(), 3)
+        self.assertNotEqual(cluster.id, "12CAA")
+        self.assertNotEqual(ZincSite.objects.get(id="12CA-1").group.id, "12CA-1")
+        Chain.objects.filter(id="12CAA").update(cluster=None)
+        cluster_main(incremental=True, backend="kmer")
+        self.assertEqual(Chain.objects.get(id="12CAA").cluster, cluster)
+
+
+class StatsMigrationTests(TransactionTestCase):
+
+    fixtures = ["pre-cluster.json"]
+
+    def migrate(self, migration):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([("core", migration)])
+
+
+    def test_migrating_populated_database_saves_stats(self):
+        graph = MigrationExecutor(connection).loader.graph
+        latest = graph.leaf_nodes("core")[0][1]
+        self.migrate("0005_hierarchy")
+        self.migrate("0006_stats")
+        self.migrate(latest)
+        rows = dict(StatsCount.objects.filter(
+         statistic="rows"
+        ).values_list("label", "count"))
+        self.assertEqual(rows["Chain"], 15)
+        self.assertEqual(rows["ZincSite"], 19)
+        self.assertEqual(sum(StatsCount.objects.filter(
+         statistic="resolutions"
+        ).values_list("count", flat=True)), 19)
+
+
+class BestModelTests(SimpleTestCase):
+
+    def setUp(self):
+        residue = Residue(
+         Atom("S", 0, 0, 2.3, 1, "SG", 0, 0, [0] * 6), id="A.1", name="CYS"
+        )
+        chain = AtomiumChain(residue, id="A", internal_id="A")
+        zinc = Ligand(Atom("Zn", 0, 0, 0, 2, "ZN", 0, 0, [0] * 6),
+         id="A.100", name="ZN", chain=chain, internal_id="B")
+        sulphate = Ligand(Atom("S", 9, 9, 9, 3, "S", 0, 0, [0] * 6),
+         id="A.101", name="SO4", chain=chain, internal_id="C")
+        self.pdb = File("cif")
+        self.pdb._code = "1ABC"
+        self.pdb._models = [Model(chain, zinc, sulphate)]
+
+
+    def make_assembly(self, id, energy, chains):
+        return {"id": id, "delta_energy": energy, "transformations": [{
+         "chains": chains, "matrix": [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+         "vector": [0, 0, 0]
+        }]}
+
+
+    def test_lowest_energy_assembly_with_metals_is_generated(self):
+        self.pdb._assemblies = [
+         self.make_assembly(1, None, ["A", "B"]),
+         self.make_assembly(2, -10, ["A", "C"]),
+         self.make_assembly(3, -5, ["A", "B"])
+        ]
+        with patch.object(
+         self.pdb, "generate_assembly", wraps=self.pdb.generate_assembly
+        ) as mock_generate:
+            model, assembly = get_best_model(self.pdb)
+        self.assertEqual(assembly, 3)
+        mock_generate.assert_called_once_with(3)
+        self.assertEqual([a.element for a in model.atoms(is_metal=True)], ["Zn"])
+
+
+    def test_assemblies_without_metals_are_rejected(self):
+        self.pdb._assemblies = [self.make_assembly(1, -10, ["A", "C"])]
+        with self.assertRaises(ValueError):
+            get_best_model(self.pdb)
+
+
+    def test_model_is_used_without_assemblies(self):
+        self.pdb._assemblies = []
+        self.assertEqual(get_best_model(self.pdb), (self.pdb.model, None))
+
+
+class PdbIndexTests(TestCase):
+
+    def setUp(self):
+        self.titles = {
+         "1AAA": "CARBONIC ANHYDRASE II", "1BBB": "HUMAN CARBONIC ANHYDRASE",
+         "1CCC": "INSULIN HEXAMER", "1DDD": "ZINC FINGER PROTEIN", "1EEE": "AB"
+        }
+        for id, title in self.titles.items():
+            Pdb.objects.create(
+             id=id, title=title, keywords="LYASE", classification="LYASE",
+             skeleton=False
+            )
+
+
+    def test_index_holds_pdb_information(self):
+        index = PdbIndex()
+        self.assertEqual(len(index.pdbs), 5)
+        self.assertEqual(index.pdbs["1CCC"], ("INSULIN HEXAMER", "LYASE", "LYASE"))
+        self.assertEqual(index.trigrams["HEX"], {"1CCC"})
+        self.assertEqual(index.trigrams["ANH"], {"1AAA", "1BBB"})
+
+
+    def test_can_find_pdbs_whose_titles_contain_keywords(self):
+        index = PdbIndex()
+        for keyword in ["CARBONIC ANHYDRASE", "ANHYDRASE II", "ZINC", "IN",
+         "AB", "A", "HUMAN INSULIN", "ASE", "XYZ", ""]:
+            self.assertEqual(index.get_title_matches(keyword), {
+             id for id, title in self.titles.items() if keyword in title
+            })
+
+
+    def test_matches_are_remembered(self):
+        index = PdbIndex()
+        matches = index.get_title_matches("ANHYDRASE")
+        index.trigrams.clear()
+        self.assertIs(index.get_title_matches("ANHYDRASE"), matches)
+
+
+class MetalGroupMergingTests(SimpleTestCase):
+
+    def quadratic_merge_metal_groups(self, sites):
+        # The original merging algorithm, which restarts after every merge
+        while not check_sites_have_unique_residues(sites):
+            for site1, site2 in combinations(sites, 2):
+                if get_site_residues(site1).intersection(get_site_residues(site2)):
+                    site1["metals"].update(site2["metals"])
+                    sites.remove(site2)
+                    break
+        return sites
+
+
+    def test_merging_matches_quadratic_merging(self):
+        rng = random.Random(42)
+        for trial in range(500):
+            residues = [Mock() for _ in range(rng.randint(1, 40))]
+            sites = [{"metals": {Mock(): [
+             Mock(het=rng.choice(residues)) for _ in range(rng.randint(1, 4))
+            ]}} for _ in range(rng.randint(0, 30))]
+            expected = self.quadratic_merge_metal_groups(
+             [{"metals": dict(site["metals"])} for site in sites]
+            )
+            merged = merge_metal_groups(
+             [{"metals": dict(site["metals"])} for site in sites]
+            )
+            self.assertEqual(merged, expected)
+            self.assertTrue(check_sites_have_unique_residues(merged))
+
+
+
+class SequenceAlignmentTests(SimpleTestCase):
+
+    def quadratic_align_sequences(self, seq1, seq2):
+        # The original alignment, which fills in the score matrix cell by cell
+        m, n = len(seq1), len(seq2)
+        score = [[0 for y in range(n + 1)] for x in range(m + 1)]
+        for i in range(0, m + 1): score[i][0] = -5 * i
+        for j in range(0, n + 1): score[0][j] = -5 * j
+        for i in range(1, m + 1):
+            for j in range(1, n + 1):
+                score[i][j] = max(
+                 score[i - 1][j - 1] + match_score(
+                  seq1[i-1], seq2[j-1], 10, -5, -5
+                 ),
+                 score[i - 1][j] - 5, score[i][j - 1] - 5
+                )
+        align1, align2 = "", ""
+        i, j = m, n
+        while i > 0 and j > 0:
+            if score[i][j] == score[i - 1][j - 1] + match_score(
+             seq1[i-1], seq2[j-1], 10, -5, -5
+            ):
+                align1 += seq1[i - 1]
+                align2 += seq2[j - 1]
+                i -= 1
+                j -= 1
+            elif score[i][j] == score[i - 1][j] - 5:
+                align1 += seq1[i - 1]
+                align2 += "-"
+                i -= 1
+            elif score[i][j] == score[i][j - 1] - 5:
+                align1 += "-"
+                align2 += seq2[j - 1]
+                j -= 1
+        while i > 0:
+            align1 += seq1[i - 1]
+            align2 += "-"
+            i -= 1
+        while j > 0:
+            align1 += "-"
+            align2 += seq2[j - 1]
+            j -= 1
+        return align1[::-1], align2[::-1]
+
+
+    def test_alignment_matches_quadratic_alignment(self):
+        pairs = [
+         ("", ""), ("A", ""), ("", "A"), ("HCH", "HCH"), ("HCH", "CHH"),
+         ("MKVLAAGHCHEE", "MKVLGHCHEEK"), ("AC-DE", "ACDE"), ("CCCC", "HHHH"),
+         ("MADEEKLPPGWEKRMSRSSGRVYYFNHITNASQWERPSG",
+          "KLPPGWEKAMSRSSGRVYYFNHITNASQW")
+        ]
+        rng = random.Random(42)
+        for trial in range(200):
+            pairs.append(tuple("".join(rng.choice("ACDEGHKLMSW-")
+             for _ in range(rng.randint(0, 60))) for _ in range(2)))
+        for seq1, seq2 in pairs:
+            self.assertEqual(
+             align_sequences(seq1, seq2),
+             self.quadratic_align_sequences(seq1, seq2)
+            )
+
+
+
+class KmerClusteringTests(SimpleTestCase):
+
+    def setUp(self):
+        rng, residues = random.Random(42), "ACDEFGHIKLMNPQRSTVWY"
+        self.short = "".join(rng.choice(residues) for _ in range(60))
+        self.extra = "".join(rng.choice(residues) for _ in range(90))
+
+
+    def test_longer_chain_can_match_shorter_representative(self):
+        clusters = match_sequences(
+         [("1", self.short)], [("2", self.short + self.extra)], 0.9
+        )
+        self.assertEqual(clusters, [["1", "2"]])
+
+
+    def test_shorter_chain_can_join_longer_representative(self):
+        clusters = cluster_sequences(
+         [("1", self.short), ("2", self.short + self.extra)], 0.9
+        )
+        self.assertEqual(clusters, [["2", "1"]])
+
+
+
+class CdHitTests(SimpleTestCase):
+
+    def test_can_parse_cluster_file(self):
+        path = os.path.join(os.path.dirname(__file__), "files", "chains.clstr")
+        self.assertEqual(list(parse_cluster_file(path)), [
+         ["12CAA", "1BNTA", "1G48A"], ["3HUDA"], ["1XDAF", "1IZBB"]
+        ])
+
+
+    @patch("os.sched_getaffinity", create=True)
+    def test_cd_hit_uses_available_cpus_and_memory(self, mock_affinity):
+        mock_affinity.return_value = {0, 1, 2}
+        meminfo = "MemTotal:  4096000 kB\nMemAvailable:  1024000 kB\n"
+        with patch("builtins.open", mock_open(read_data=meminfo)):
+            self.assertEqual(get_cd_hit_resources(), (3, 800))
+        with patch("builtins.open", side_effect=OSError):
+            self.assertEqual(get_cd_hit_resources(), (3, 0))
+        with patch("builtins.open", mock_open(read_data=meminfo)):
+            with patch("subprocess.run") as mock_run:
+                run_cd_hit("cd-hit", 0.9, "-i", "chains.fasta")
+        args = mock_run.call_args[0][0]
+        self.assertEqual(args[:3], ["cd-hit", "-i", "chains.fasta"])
+        self.assertEqual(args[args.index("-T") + 1], "3")
+        self.assertEqual(args[args.index("-M") + 1], "800")
+        self.assertEqual(args[args.index("-n") + 1], "5")